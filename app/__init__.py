@@ -1,5 +1,6 @@
 import os.path as path
 import json
+import time
 from PIL import Image
 from StringIO import StringIO
 from flask import Flask, render_template, request, abort, Response, Blueprint, redirect
@@ -29,6 +30,61 @@ def create_app(**config):
     
     app.db = api.auth_layer.init(config.get('CLIENT', None))
     app.register_blueprint(api.create_api(app), url_prefix='/api')
+    if app.config.get('ENSURE_INDEXES', True):
+        app.db.ensure_indexes()
+
+    app.user_cache = api.LRUCache(app.config.get('USER_CACHE_SIZE', 1000),
+                                  app.config.get('USER_CACHE_TTL', 60))
+
+    cache_size = app.config.get('RESPONSE_CACHE_SIZE', 0)
+    app.response_cache = api.ResponseCache(cache_size) if cache_size else None
+
+    def invalidate(name):
+        if name == 'users':
+            app.user_cache.clear()
+        if app.response_cache is not None:
+            app.response_cache.invalidate(name)
+    app.db.write_listeners.append(invalidate)
+    # writes only bump the stored collection versions when ETags or the response cache use them
+    app.db.versioned = lambda: bool(app.config.get('ETAGS', False) or app.response_cache is not None)
+
+    app.metrics = api.metrics.Metrics()
+
+
+    @app.before_request
+    def start_timing():
+        if app.config.get('TIMING', False):
+            api.timing.enabled = True
+            api.timing.start()
+            request.timing_start = time.time()
+
+    @app.before_request
+    def start_metrics():
+        request.metrics_start = time.time()
+
+    @app.after_request
+    def emit_timing(response):
+        timings = api.timing.stop()
+        if timings is not None:
+            if hasattr(request, 'timing_start'):
+                timings['total'] = [time.time() - request.timing_start, 1]
+            response.headers['Server-Timing'] = api.timing.header(timings)
+            api.timing.log.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'timings': api.timing.summary(timings),
+            }, sort_keys=True))
+        return response
+
+    @app.after_request
+    def record_metrics(response):
+        labels = api.metrics.route_labels(request.endpoint)
+        if labels is not None and hasattr(request, 'metrics_start'):
+            app.metrics.observe(labels + (request.method, response.status_code),
+                                time.time() - request.metrics_start)
+        return response
+
 
     
     @app.before_request
@@ -41,9 +97,14 @@ def create_app(**config):
             username = request.environ['TEST_USER']
         else:
             abort(403)
-        request.user = app.db.users.find_one({'username':username})
+        if not (request.endpoint or '').startswith('api.'):
+            return                          # static files and index pages need no user lookup
+        request.user = app.user_cache.get(username)
         if request.user is None:
-            abort(403)
+            request.user = app.db.users.find_one({'username':username})
+            if request.user is None:
+                abort(403)
+            app.user_cache.set(username, request.user)
 
 
     #@app.errorhandler(404)
@@ -54,6 +115,13 @@ def create_app(**config):
     @app.route('/')
     def index():
         return app.send_static_file('index.html')
+
+    @app.route('/metrics')
+    def metrics():
+        lines = app.metrics.render()
+        if app.response_cache is not None:
+            lines += api.metrics.cache_lines('flipserver_response_cache', app.response_cache.stats())
+        return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
     
     
     return app
@@ -1,10 +1,15 @@
 from flask import Blueprint
 import views
 import auth_layer
+from auth_layer import timing
+import metrics
+import compress
+from cache import LRUCache, ResponseCache
 
 
 def create_api(app):
     api = Blueprint('api', 'api')
+    api.after_request(compress.compress_response)
     setup_endpoints(app, api)
     return api
 
@@ -19,10 +24,13 @@ def create_endpoint(app, api, name, endpoint):
     app.db.register_endpoint(name, endpoint)     
     api.add_url_rule('/%s' % name, '%s_api_list' % name,
                          views.api_list_view_factory(app.db, name),
-                         methods=['GET', 'POST'])    
+                         methods=['GET', 'POST', 'PUT', 'DELETE'])    
     api.add_url_rule('/%s/<int:id>' % name, '%s_api_item' % name,
                          views.api_item_view_factory(app.db, name),
-                         methods=['GET', 'PUT', 'DELETE'])
+                         methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+    api.add_url_rule('/%s/_aggregate' % name, '%s_api_aggregate' % name,
+                         views.api_aggregate_view_factory(app.db, name),
+                         methods=['GET'])
 
 
 def create_index_server(app, name):
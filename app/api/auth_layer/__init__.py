@@ -1,5 +1,6 @@
 
 from database import AuthDatabaseWrapper
+from auth_doc import ReadFilter
 
 
 db = None
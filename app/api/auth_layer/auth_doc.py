@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import inspect
 from schemongo.schema_layer.schema_doc import is_object, is_list_of_objects, DBDoc, generate_prototype
+from timing import timed
 
 
 def AuthState():
@@ -12,51 +14,215 @@ def AuthState():
     }
 
 
-def resolve_state(key, auth_cfg, auth_state, doc):
+class ReadFilter(object):
+    """
+    Declarative endpoint auth.read - a Mongo filter fragment, or a function
+    of the request's user (None without one) returning such a fragment.  It
+    is ANDed into the query, so documents it excludes are never fetched.
+    A plain dict as auth.read is taken as a fragment as well.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+
+    def fragment(self, user=None):
+        if callable(self.spec):
+            return self.spec(user)
+        return self.spec
+
+
+def is_read_filter(auth):
+    return isinstance(auth, (ReadFilter, dict))
+
+
+def read_filter(endpoint, user=None):
+    """The filter fragment for an endpoint's declarative read auth, or None"""
+    auth = endpoint.get('auth', {}).get('read')
+    if isinstance(auth, ReadFilter):
+        return auth.fragment(user)
+    if isinstance(auth, dict):
+        return auth
+    return None
+
+
+def restricted_paths(endpoint, prefix=''):
+    """Dotted paths of the subdocuments and lists whose read auth isn't a plain True"""
+    result = []
+    for key, val in endpoint['schema'].items():
+        if is_object(val):
+            sub = val
+        elif is_list_of_objects(val):
+            sub = val['schema']
+        else:
+            continue
+        if sub.get('auth', {}).get('read', True) is not True:
+            result.append(prefix + key)
+        else:
+            result.extend(restricted_paths(sub, prefix + key + '.'))
+    return result
+
+
+_arities = {}
+
+def auth_arity(fcn):
+    """
+    1 if the auth callable takes the document, 0 if it takes nothing, None
+    if it can't be told (builtins, partials, callable objects).
+    """
+    try:
+        return _arities[fcn]
+    except KeyError:
+        pass
+    except TypeError:
+        return None
+    if not (inspect.isfunction(fcn) or inspect.ismethod(fcn)):
+        return None
+    spec = inspect.getargspec(fcn)
+    args = spec.args
+    if inspect.ismethod(fcn) and fcn.__self__ is not None:
+        args = args[1:]
+    _arities[fcn] = 1 if (args or spec.varargs) else 0
+    return _arities[fcn]
+
+
+def static_read(endpoint):
+    """
+    The endpoint's top-level read auth when it doesn't depend on the
+    document - True for read filters, which the query applies - or None
+    for a per-document callable.
+    """
+    auth = endpoint.get('auth', {}).get('read', True)
+    if is_read_filter(auth):
+        return True
+    if callable(auth):
+        if auth_arity(auth) != 0:
+            return None
+        auth = auth()
+    return bool(auth)
+
+
+def compile_plan(endpoint, subdoc=False):
+    """
+    Precomputes, for an endpoint or subdocument config, its auth config and
+    the object and list-of-object keys that carry authstates, so that
+    add_authstates doesn't walk the whole schema for every document.  Auth
+    callables are classified along the way.
+    """
+    auth_cfg = endpoint.get('auth', {})
+    if subdoc and is_read_filter(auth_cfg.get('read')):
+        raise ValueError('Filter-style read auth is only supported at the endpoint level')
+    for val in auth_cfg.values():
+        if callable(val):
+            auth_arity(val)
+    objects = []
+    lists = []
+    for key, val in endpoint['schema'].items():
+        if is_object(val):
+            objects.append((key, val))
+            compile_plan(val, subdoc=True)
+        if is_list_of_objects(val):
+            lists.append((key, val['schema'], val['schema'].get('auth', {})))
+            compile_plan(val['schema'], subdoc=True)
+    endpoint['_authplan'] = (auth_cfg, objects, lists)
+    return endpoint['_authplan']
+
+
+def get_plan(endpoint):
+    try:
+        return endpoint['_authplan']
+    except KeyError:
+        return compile_plan(endpoint)
+
+
+def resolve_state(key, auth_cfg, auth_state, doc, memo=None):
     result = auth_cfg.get(key[1:], auth_state[key])
-    if callable(result):
-        try:
+    if is_read_filter(result):        # already applied in the query
+        result = True
+    elif callable(result):
+        arity = auth_arity(result)
+        if arity == 1:
             result = result(doc)
-        except TypeError:             # auth.read() can have zero or one args - either
-            result = result()         # case applies here
+        elif arity == 0:              # zero-arg callables can't depend on the doc, so
+            if memo is None:          # their result is shared through memo
+                result = result()
+            else:
+                if result not in memo:
+                    memo[result] = result()
+                result = memo[result]
+        else:
+            try:
+                result = result(doc)
+            except TypeError:         # auth.read() can have zero or one args - either
+                result = result()     # case applies here
     return result
 
 
-def add_authstates(endpoint, doc, auth_state=None, subdoc=False):
-    schema = endpoint['schema']
-    auth_cfg = endpoint.get('auth', {})
+def projection_tree(fields):
+    """
+    Nested dict of the keys an inclusion projection asks for, with None
+    marking a key included whole.  Returns None when nothing is pruned.
+    """
+    if not fields:
+        return None
+    if isinstance(fields, dict):
+        keys = [key for key, val in fields.items() if val]
+        if not keys:                  # exclusion projection
+            return None
+    else:
+        keys = list(fields)
+    tree = {}
+    for key in keys:
+        node = tree
+        parts = key.split('.')
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+@timed('add_authstates')
+def add_authstates(endpoint, doc, auth_state=None, subdoc=False, memo=None, proj=None):
+    """
+    With proj (a projection_tree), subdocuments and lists outside the
+    projection are not resolved - they won't be sent anyway.
+    """
+    auth_cfg, objects, lists = get_plan(endpoint)
     auth_state = (auth_state and dict(auth_state)) or AuthState()
 
-    auth_state['_read'] = resolve_state('_read', auth_cfg, auth_state, doc)
-    auth_state['_edit'] = resolve_state('_edit', auth_cfg, auth_state, doc)
-    auth_state['_delete'] = resolve_state('_delete', auth_cfg, auth_state, doc)    
-    lists = {}
+    auth_state['_read'] = resolve_state('_read', auth_cfg, auth_state, doc, memo)
+    auth_state['_edit'] = resolve_state('_edit', auth_cfg, auth_state, doc, memo)
+    auth_state['_delete'] = resolve_state('_delete', auth_cfg, auth_state, doc, memo)    
+    creates = {}
 
-    for key, val in schema.items():
-        if is_object(val) and key in doc:
-            add_authstates(val, doc[key], auth_state, subdoc=True)
-            
-        if is_list_of_objects(val):
-            lists[key] = resolve_state('_create', val['schema'].get('auth', {}), auth_state, doc)
-            
-            new_auth_state = dict(auth_state)
-            new_auth_state['_create'] = lists[key]
-            
-            if key in doc:
-                for item in doc[key]:
-                    add_authstates(val['schema'], item, new_auth_state)
+    for key, val in objects:
+        if key in doc and (proj is None or key in proj):
+            add_authstates(val, doc[key], auth_state, subdoc=True, memo=memo,
+                           proj=proj and proj[key])
+
+    for key, val, list_auth in lists:
+        if proj is not None and key not in proj:
+            continue
+        creates[key] = resolve_state('_create', list_auth, auth_state, doc, memo)
+        
+        new_auth_state = dict(auth_state)
+        new_auth_state['_create'] = creates[key]
+        
+        if key in doc:
+            for item in doc[key]:
+                add_authstates(val, item, new_auth_state, memo=memo, proj=proj and proj[key])
                 
-    auth_state.update(lists)
+    auth_state.update(creates)
     doc._authstate = auth_state
     
 
 
-def get_by_id(list, id):
-    for item in list:
-        if item['_id'] == id:
-            return item
+def index_by_id(list):
+    return dict((item['_id'], item) for item in list)
     
 
+@timed('enforce_auth_read')
 def enforce_auth_read(endpoint, doc, data=None):
     schema = endpoint['schema']
     data = data or doc._projection
@@ -67,14 +233,18 @@ def enforce_auth_read(endpoint, doc, data=None):
             else:
                 enforce_auth_read(schema[key], doc[key], val)
         if key in schema and is_list_of_objects(schema[key]):
-            for item in val[:]:
-                if not get_by_id(doc[key], item['_id'])._authstate['_read']:
-                    val.remove(item)
-                else:
-                    enforce_auth_read(schema[key]['schema'], get_by_id(doc[key], item['_id']), item)
+            subdocs = index_by_id(doc[key])
+            readable = []
+            for item in val:
+                sdoc = subdocs[item['_id']]
+                if sdoc._authstate['_read']:
+                    enforce_auth_read(schema[key]['schema'], sdoc, item)
+                    readable.append(item)
+            val[:] = readable
 
 
 
+@timed('enforce_auth')
 def enforce_auth(endpoint, doc, incoming):
     schema = endpoint['schema']
 
@@ -94,16 +264,21 @@ def enforce_auth(endpoint, doc, incoming):
                     incoming[key] = filter(lambda x: x.get('_id', False), incoming[key])
                     
                 # Check for edited or deleted items
-                ids = [x.get('_id',0) for x in incoming[key]]
+                received = {}
+                for item in incoming[key]:
+                    received.setdefault(item.get('_id',0), item)
+                restored = []
                 for i,item in enumerate(doc[key]):
-                    if item._id in ids and not item._authstate['_edit']:
-                        remove_data(val['schema']['schema'], incoming[key][ids.index(item._id)])
+                    if item._id in received and not item._authstate['_edit']:
+                        remove_data(val['schema']['schema'], received[item._id])
                     
-                    if item._id not in ids and not item._authstate['_delete']:
-                        incoming[key].insert(i, {'_id':item._id})
+                    if item._id not in received and not item._authstate['_delete']:
+                        restored.append((i, {'_id':item._id}))
+                if restored:
+                    incoming[key] = reinsert(incoming[key], restored)
                         
                 # Enforce on remaining items
-                ids = [x._id for x in doc[key]]
+                subdocs = index_by_id(doc[key])
                 for item in incoming[key]:
                     if not item.get('_id',0):
                         sdoc = generate_prototype(val['schema']['schema'])
@@ -111,8 +286,24 @@ def enforce_auth(endpoint, doc, incoming):
                         new_state['_create'] = True
                         add_authstates(val['schema'], sdoc, new_state)
                     else:
-                        sdoc = doc[key][ids.index(item['_id'])]
+                        sdoc = subdocs[item['_id']]
                     enforce_auth(val['schema'], sdoc, item)
+
+
+def reinsert(items, restored):
+    """
+    Same result as items.insert(i, item) for each (i, item) of restored in
+    ascending order, in a single pass.
+    """
+    result = []
+    pos = 0
+    for i, item in restored:
+        while len(result) < i and pos < len(items):
+            result.append(items[pos])
+            pos += 1
+        result.append(item)
+    result.extend(items[pos:])
+    return result
                 
                 
 def remove_data(schema, incoming):
@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 
+import copy
+import itertools
+import logging
 from schemongo.schema_layer.database import SchemaDatabaseWrapper, SchemaCollectionWrapper, SchemaCursorWrapper
 from schemongo.schema_layer.schema_doc import is_object, is_list_of_objects, generate_prototype, enforce_schema_behaviors, \
                                               enforce_datatypes, fill_in_prototypes, merge, run_auto_funcs
-from auth_doc import add_authstates, enforce_auth, enforce_auth_read, remove_data
+from auth_doc import add_authstates, enforce_auth, enforce_auth_read, remove_data, compile_plan, read_filter, \
+                     projection_tree, static_read
+from timing import timed
 
 """
 Config:
 
+indexes: [          (optional - {_active: 1, _id: 1} is always created)
+    'username',
+    [['owner', 1], ['name', -1]],
+    {'keys': ['email'], 'unique': True},
+],
 auth: {
     create:
-    read:
+    read:           (at this level may also be a ReadFilter or a Mongo filter dict)
     edit:
     delete:
 },
@@ -40,6 +50,183 @@ schema: {
 """
 
 
+VERSIONS = '_versions'
+DEFAULT_INDEX = [('_active', 1), ('_id', 1)]
+
+log = logging.getLogger('flipserver.indexes')
+
+
+def referenced_collections(cfg):
+    result = set()
+    if isinstance(cfg, dict):
+        if cfg.get('type') == 'reference' and 'collection' in cfg:
+            result.add(cfg['collection'])
+        for val in cfg.values():
+            result |= referenced_collections(val)
+    return result
+
+
+def index_specs(endpoint):
+    """An endpoint's indexes as (keys, options) pairs, the default one first"""
+    result = [(DEFAULT_INDEX, {})]
+    for spec in endpoint.get('indexes', []):
+        options = {}
+        if isinstance(spec, dict):
+            options = dict((key, val) for key, val in spec.items() if key != 'keys')
+            spec = spec['keys']
+        if isinstance(spec, basestring):
+            spec = [spec]
+        keys = [(x, 1) if isinstance(x, basestring) else tuple(x) for x in spec]
+        if (keys, options) not in result:
+            result.append((keys, options))
+    return result
+
+
+def aggregate(coll, pipeline):
+    """Runs pipeline on a pymongo collection, returning the result documents as a list"""
+    result = coll.aggregate(pipeline)
+    if isinstance(result, dict):        # pymongo 2 returns the command response
+        return result['result']
+    return list(result)
+
+
+PIPELINE_STAGES = ('$match', '$group', '$sort', '$limit')
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+QUERY_OPERATORS = LOGICAL_OPERATORS + (
+    '$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$not',
+    '$exists', '$type', '$regex', '$options', '$mod', '$size', '$all', '$elemMatch',
+)
+EXPRESSION_OPERATORS = (
+    '$sum', '$avg', '$min', '$max', '$first', '$last', '$push', '$addToSet', '$count',
+    '$add', '$subtract', '$multiply', '$divide', '$abs', '$ceil', '$floor',
+    '$cmp', '$cond', '$ifNull', '$concat', '$substr', '$toLower', '$toUpper',
+    '$year', '$month', '$week', '$dayOfMonth', '$dayOfWeek', '$dayOfYear', '$hour',
+)
+ALLOWED_OPERATORS = frozenset(QUERY_OPERATORS + EXPRESSION_OPERATORS)
+
+
+def field_refs(value, fields=True):
+    """
+    Field paths referred to by part of a pipeline - keys of query documents
+    (when fields) and '$path' strings of expressions.  Raises ValueError for
+    operators outside ALLOWED_OPERATORS.
+    """
+    if isinstance(value, dict):
+        for key, val in value.items():
+            if key.startswith('$') and key not in ALLOWED_OPERATORS:
+                raise ValueError('%s is not allowed' % key)
+            if fields and not key.startswith('$'):
+                yield key
+            for ref in field_refs(val, fields and key in LOGICAL_OPERATORS):
+                yield ref
+    elif isinstance(value, list):
+        for val in value:
+            for ref in field_refs(val, fields):
+                yield ref
+    elif isinstance(value, basestring) and value.startswith('$'):
+        if value.startswith('$$'):
+            raise ValueError('Pipeline variables are not allowed')
+        yield value[1:]
+
+
+def pipeline_refs(pipeline):
+    """
+    Checks that pipeline only has \$match, \$group, \$sort and \$limit stages,
+    raising ValueError otherwise.  Returns the field paths it refers to.
+    """
+    if not isinstance(pipeline, list):
+        raise ValueError('pipeline must be a list of stages')
+    refs = set()
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1 or stage.keys()[0] not in PIPELINE_STAGES:
+            raise ValueError('Only %s stages are allowed' % ', '.join(PIPELINE_STAGES))
+        name, val = stage.items()[0]
+        if name == '$limit':
+            if isinstance(val, bool) or not isinstance(val, (int, long)) or val < 1:
+                raise ValueError('$limit must be a positive integer')
+        elif name == '$group':
+            if not isinstance(val, dict):
+                raise ValueError('$group must be a document')
+            refs.update(field_refs(val, fields=False))
+        else:
+            if not isinstance(val, dict):
+                raise ValueError('%s must be a document' % name)
+            refs.update(field_refs(val))
+    return refs
+
+
+def index_usage(coll):
+    """{index name: operations}, from \$indexStats - {} where the server doesn't support it"""
+    try:
+        return dict((x['name'], x['accesses']['ops']) for x in aggregate(coll, [{'$indexStats': {}}]))
+    except Exception:
+        return {}
+
+
+def plain(value):
+    """Deep copy of a document as plain dicts and lists"""
+    if isinstance(value, dict):
+        return dict((key, plain(val)) for key, val in value.items())
+    if isinstance(value, list):
+        return [plain(val) for val in value]
+    return value
+
+
+def same_ids(before, after):
+    return (len(before) == len(after) and
+            all(isinstance(x, dict) and isinstance(y, dict) and '_id' in x and x.get('_id') == y.get('_id')
+                for x, y in zip(before, after)))
+
+
+def reshaped(before, after):
+    """
+    Whether a list of subdocuments in after gained, lost or reordered items
+    compared to before, or holds items without an _id
+    """
+    for key, val in after.items():
+        old = before.get(key)
+        if isinstance(val, dict):
+            if reshaped(old if isinstance(old, dict) else {}, val):
+                return True
+        elif isinstance(val, list):
+            old = old if isinstance(old, list) else []
+            if any(isinstance(x, dict) for x in old + val):
+                if not same_ids(old, val):
+                    return True
+                if any(reshaped(x, y) for x, y in zip(old, val)):
+                    return True
+    return False
+
+
+def diff_update(before, after, prefix='', result=None):
+    """
+    (changes, guards) turning document before into after.  changes is a
+    Mongo update of \$set and \$unset on the changed paths only - lists of
+    subdocuments holding the same _ids in the same order are descended by
+    index.  guards is a spec of those subdocuments' _ids, so the update
+    matches nothing if the lists were reordered in the meantime.
+    """
+    changes, guards = result or ({}, {})
+    for key, val in after.items():
+        path = prefix + key
+        old = before.get(key)
+        if key in before and old == val:
+            continue
+        if isinstance(old, dict) and isinstance(val, dict):
+            diff_update(old, val, path + '.', (changes, guards))
+        elif isinstance(old, list) and isinstance(val, list) and same_ids(old, val):
+            for i, (x, y) in enumerate(zip(old, val)):
+                if x != y:
+                    guards['%s.%d._id' % (path, i)] = x['_id']
+                    diff_update(x, y, '%s.%d.' % (path, i), (changes, guards))
+        else:
+            changes.setdefault('$set', {})[path] = val
+    for key in before:
+        if key not in after:
+            changes.setdefault('$unset', {})[prefix + key] = ''
+    return changes, guards
+
+
 def gen_auth(authstate, subdoc=False):
     result = dict(authstate)
     result.pop('_create')
@@ -54,12 +241,35 @@ class AuthDatabaseWrapper(SchemaDatabaseWrapper):
     def __init__(self, *args, **kwords):
         super(AuthDatabaseWrapper, self).__init__(*args, **kwords)
         self.endpoints = {}
+        self.dependencies = {}
+        self.write_listeners = []
+        self.versioned = lambda: False      # whether anything reads the write versions
+        self.indexes = {}
         
     def __getitem__(self, key):
-        return AuthCollectionWrapper(self.endpoints[key], self._db[key], self)
+        return AuthCollectionWrapper(self.endpoints[key], self._db[key], self, key)
+
+    def notify_write(self, key):
+        if key is not None and self.versioned():
+            self._db[VERSIONS].coll.update({'_id': key}, {'$inc': {'version': 1}}, upsert=True)
+        for listener in self.write_listeners:
+            listener(key)
+
+    def versions(self, keys):
+        """
+        Write versions of the given collections, bumped by every insert, update
+        and remove made through an AuthCollectionWrapper while versioned() is
+        true.  0 if never written.
+        """
+        found = self._db[VERSIONS].coll.find({'_id': {'$in': list(keys)}})
+        found = dict((x['_id'], x['version']) for x in found)
+        return [found.get(key, 0) for key in keys]
         
     def register_endpoint(self, key, endpoint):
         self.endpoints[key] = endpoint
+        # collections whose writes can change this endpoint's output
+        self.dependencies[key] = [key] + sorted(referenced_collections(endpoint['schema']) - set([key]))
+        self.indexes[key] = index_specs(endpoint)
         schema = endpoint['schema']
         schema['_auth'] = {
             'type': 'dict',
@@ -70,8 +280,48 @@ class AuthDatabaseWrapper(SchemaDatabaseWrapper):
             'default': True
         }
         self._add_auth_schemas(schema)
+        compile_plan(endpoint)
         self.register_schema(key, schema)
                                 
+    def ensure_indexes(self):
+        """
+        Creates every endpoint's declared indexes (in the background) and
+        logs the index report.  Returns {endpoint: report}.
+        """
+        reports = {}
+        for key in sorted(self.indexes):
+            coll = self._db[key].coll
+            for keys, options in self.indexes[key]:
+                try:
+                    coll.create_index(keys, background=True, **options)
+                except Exception as e:
+                    log.error('%s: could not create index %s: %s', key, keys, e)
+            reports[key] = self.index_report(key)
+            for keys in reports[key]['missing']:
+                log.warning('%s: missing index %s', key, keys)
+            for name in reports[key]['undeclared']:
+                log.warning('%s: undeclared index %s', key, name)
+            for name in reports[key]['unused']:
+                log.info('%s: index %s has not been used since the server started', key, name)
+        return reports
+
+    def index_report(self, key):
+        """
+        missing - declared indexes that don't exist; undeclared - existing
+        indexes that aren't declared; unused - indexes \$indexStats reports
+        no use of
+        """
+        coll = self._db[key].coll
+        existing = dict((name, [tuple(x) for x in info['key']])
+                        for name, info in coll.index_information().items())
+        declared = [keys for keys, options in self.indexes[key]]
+        usage = index_usage(coll)
+        return {
+            'missing': [keys for keys in declared if keys not in existing.values()],
+            'undeclared': sorted(name for name, keys in existing.items() if name != '_id_' and keys not in declared),
+            'unused': sorted(name for name in existing if usage.get(name) == 0),
+        }
+
     def _add_auth_schemas(self, schema):
         for key, val in schema.items():
             if is_object(val):
@@ -90,38 +340,225 @@ class AuthDatabaseWrapper(SchemaDatabaseWrapper):
 
 
 class AuthCollectionWrapper(SchemaCollectionWrapper):
-    def __init__(self, endpoint, collection, db):
+    def __init__(self, endpoint, collection, db, name=None):
         super(AuthCollectionWrapper, self).__init__(endpoint['schema'], collection, db)
         self.endpoint = endpoint    
+        self.name = name
+        self._loaded = {}
+
+    def _read_spec(self, spec, user):
+        fragment = read_filter(self.endpoint, user)
+        if fragment:
+            spec = {'$and': [spec, fragment]}
+        return spec
 
     def find(self, spec=None, fields=None, skip=0, limit=0, sort=None, user=None):
         spec = spec or {}
         if '_active' not in spec:
             spec['_active'] = True
+        spec = self._read_spec(spec, user)
+        proj = projection_tree(fields)
         fields = fields or {'_active': 0, '_index': 0}
-        return AuthSchemaCursorWrapper(self.coll.find(spec, fields, skip, limit, sort), self.db, self.endpoint, user=None)
+        if static_read(self.endpoint):
+            # every document the query matches is readable - page in the query itself
+            return AuthSchemaCursorWrapper(self.coll.find(spec, fields, skip, limit, sort), self.db, self.endpoint,
+                                           user=None, skip=skip, limit=limit, proj=proj, server_paged=True)
+        # skip and limit are applied after the per-document read check, so pages stay full
+        return AuthSchemaCursorWrapper(self.coll.find(spec, fields, 0, 0, sort), self.db, self.endpoint,
+                                       user=None, skip=skip, limit=limit, proj=proj)
+
+    @timed('count')
+    def count(self, spec=None, user=None):
+        """
+        Number of readable, active documents matching spec.  Counted by the
+        server unless the endpoint's read auth is a per-document callable, in
+        which case the documents are streamed through the auth check.
+        """
+        spec = spec or {}
+        if '_active' not in spec:
+            spec['_active'] = True
+        read = static_read(self.endpoint)
+        if read is None:
+            return self.find(spec, user=user).total
+        if not read:
+            return 0
+        return self.raw.find(self._read_spec(spec, user)).count()
 
+    @timed('find_one')
     def find_one(self, spec_or_id, fields=None, skip=0, sort=None, user=None):
+        proj = projection_tree(fields)
         fields = fields or {'_active': 0, '_index': 0}
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        spec_or_id = self._read_spec(spec_or_id, user)
         tmp = SchemaCollectionWrapper.find_one(self, spec_or_id, fields, skip, sort)
         if not tmp:
             return tmp
-        add_authstates(self.endpoint, tmp, user)
+        add_authstates(self.endpoint, tmp, proj=proj)
         enforce_auth_read(self.endpoint, tmp)
         return tmp
     
-    def remove(self, spec_or_id, username=None):
+    @timed('find_by_ids')
+    def find_by_ids(self, ids, fields=None, user=None):
+        """
+        Fetches several documents with a single query, read as one batch, and
+        returns them in the order of ids.  As with find_one, documents are not
+        dropped for the read check.
+        """
+        proj = projection_tree(fields)
+        fields = fields or {'_active': 0, '_index': 0}
+        source = self.coll.find({'_id': {'$in': list(ids)}}, fields)
+        cursor = SchemaCursorWrapper(source, self.db, self.endpoint['schema'])
+        batches = source.cursor = BatchedCursor(source.cursor, max(len(ids), 1))
+        docs = dict((x['_id'], x) for x in (cursor[i] for i in batches.next_batch()))
+        memo = {}
+        result = []
+        for id in ids:
+            if id in docs:
+                add_authstates(self.endpoint, docs[id], memo=memo, proj=proj)
+                enforce_auth_read(self.endpoint, docs[id])
+                result.append(docs[id])
+        return result
+
+    @timed('aggregate')
+    def aggregate(self, pipeline, user=None):
+        """
+        Runs pipeline (checked by pipeline_refs) on the active documents the
+        endpoint's read filter lets through, which is prepended as a \$match.
+        """
+        match = self._read_spec({'_active': True}, user)
+        return aggregate(self.raw, [{'$match': match}] + pipeline)
+
+    def insert(self, *args, **kwords):
+        result = SchemaCollectionWrapper.insert(self, *args, **kwords)
+        self.db.notify_write(self.name)
+        return result
+
+    def update(self, *args, **kwords):
+        result = SchemaCollectionWrapper.update(self, *args, **kwords)
+        self.db.notify_write(self.name)
+        return result
+
+    def load(self, id, user=None):
+        """
+        Fetches the stored, active document with its authstates, if the read
+        filter lets user see it.  The document is kept so a following
+        update() on this wrapper does not fetch it again.
+        """
+        data = self.coll.find_one(self._read_spec({'_id': id, '_active': True}, user))
+        if data:
+            add_authstates(self.endpoint, data)
+            self._loaded[id] = data
+        return data
+
+    def load_many(self, ids, user=None):
+        """
+        load() for several ids with a single query.  Returns the ids that were
+        not found.
+        """
+        missing = set(ids)
+        memo = {}
+        for data in self.coll.find(self._read_spec({'_id': {'$in': list(ids)}, '_active': True}, user)):
+            add_authstates(self.endpoint, data, memo=memo)
+            self._loaded[data['_id']] = data
+            missing.discard(data['_id'])
+        return [id for id in ids if id in missing]
+
+    @timed('update_many')
+    def update_many(self, items, username=None):
+        """
+        Updates each of items, which should have been load_many()ed first.
+        Items with field errors are not written.  Returns the errors of each
+        item, in order.
+        """
+        errs = [SchemaCollectionWrapper.update(self, item, username=username) or [] for item in items]
+        for item in items:
+            self._loaded.pop(item['_id'], None)
+        self.db.notify_write(self.name)
+        return errs
+
+    @timed('patch')
+    def patch(self, incoming, username=None):
+        """
+        update() that writes only the paths that changed, as a \$set/\$unset
+        against the stored document, after the same auth and schema
+        enforcement.  When lists of subdocuments gain or lose items, or the
+        stored lists changed meanwhile, the document goes through the schema
+        layer's update instead, which owns ids and indexes of list items.
+        So do writes made on behalf of a username, as only that update takes
+        the username - the \$set/\$unset path is for unattributed writes.
+        Returns the field errors.
+        """
+        if username is not None:
+            return self.update(incoming, username=username)
+        original = copy.deepcopy(incoming)
+        data = self._loaded.get(incoming.get('_id')) or self.load(incoming.get('_id'))
+        before = plain(data)
+        data, errs = self.process_update(incoming)
+        if errs:
+            return errs
+
+        after = plain(data)
+        if reshaped(before, after):
+            return self.update(original)
+        changes, guards = diff_update(before, after)
+        if not changes:
+            return []
+        result = self.raw.update(dict(guards, _id=data['_id']), changes)
+        if not (result or {}).get('n', 1):          # lists reordered underneath
+            return self.update(original)
+        self.db.notify_write(self.name)
+        return []
+
+    @timed('remove')
+    def remove(self, spec_or_id, username=None, check_auth=False, user=None):
+        """
+        Soft-deletes the matching documents with a single multi-update of
+        _active.  Documents the read filter hides from user, or whose _read
+        authstate resolves False, are left alone.  With check_auth, only documents whose _delete authstate resolves True
+        are removed.  A document load()ed on this wrapper is not fetched
+        again.  Returns the list of removed ids.
+        """
         if isinstance(spec_or_id, dict):
-            data = self.coll.find(spec_or_id)
+            spec = spec_or_id
+            if '_active' not in spec:
+                spec['_active'] = True
+            spec = self._read_spec(spec, user)
+            check_read = static_read(self.endpoint) is None
+            if check_auth or check_read:
+                ids = []
+                memo = {}
+                for item in self.coll.find(spec):
+                    add_authstates(self.endpoint, item, memo=memo)
+                    if ((not check_read or item._authstate['_read']) and
+                            (not check_auth or item._authstate['_delete'])):
+                        ids.append(item['_id'])
+            else:
+                ids = [x['_id'] for x in self.raw.find(spec, {'_id': 1})]
         else:
-            data = self.coll.find({'_id': spec_or_id})
-        data = [x for x in data]
-        
-        for item in data:
-            item['_active'] = False
-            self.coll.update(item)
+            ids = [spec_or_id]
+            if check_auth or read_filter(self.endpoint, user):
+                item = self._loaded.pop(spec_or_id, None) or self.load(spec_or_id, user)
+                self._loaded.pop(spec_or_id, None)
+                if not item or (check_auth and not item._authstate['_delete']):
+                    ids = []
+
+        if ids:
+            self.raw.update({'_id': {'$in': ids}}, {'$set': {'_active': False}}, multi=True)
+            self.db.notify_write(self.name)
+        return ids
+
+    @timed('serialize')
+    def get_serial_dict(self, *args, **kwords):
+        return SchemaCollectionWrapper.get_serial_dict(self, *args, **kwords)
+
+    @property
+    def raw(self):
+        """The underlying pymongo collection, for server-side multi-document writes"""
+        return self.coll.coll
 
     
+    @timed('process_insert')
     def process_insert(self, incoming):
         errs = enforce_datatypes(self.schema, incoming)
         if errs:
@@ -141,6 +578,7 @@ class AuthCollectionWrapper(SchemaCollectionWrapper):
         return (data, [])
 
 
+    @timed('process_update')
     def process_update(self, incoming):
         assert '_id' in incoming, "Cannot update document without _id attribute"
 
@@ -148,8 +586,10 @@ class AuthCollectionWrapper(SchemaCollectionWrapper):
         if errs:
             return (None, errs)
 
-        data = self.coll.find_one({"_id":incoming["_id"]})
-        add_authstates(self.endpoint, data)
+        data = self._loaded.pop(incoming["_id"], None)
+        if data is None:
+            data = self.coll.find_one({"_id":incoming["_id"]})
+            add_authstates(self.endpoint, data)
         if not data._authstate['_edit']:
             remove_data(self.endpoint['schema'], incoming)
         enforce_auth(self.endpoint, data, incoming)
@@ -165,47 +605,152 @@ class AuthCollectionWrapper(SchemaCollectionWrapper):
     
     
     
+class BatchedCursor(object):
+    """
+    Stands in for the pymongo cursor under the schema layer's cursor wrapper.
+    The query is iterated once, batch_size documents per round trip, and
+    index i is served from the batch in memory - so reading documents by
+    index in order doesn't run a query per document.  Only the current
+    batch is kept.
+    """
+    def __init__(self, cursor, batch_size):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.start = 0
+        self.batch = []
+        self._iter = iter(cursor.batch_size(batch_size))
+
+    def next_batch(self):
+        """Reads the next batch, returning the range of its indexes"""
+        self.start += len(self.batch)
+        self.batch = list(itertools.islice(self._iter, self.batch_size))
+        return xrange(self.start, self.start + len(self.batch))
+
+    def __getitem__(self, index):
+        if not self.start <= index < self.start + len(self.batch):
+            raise IndexError('index %d is outside the current batch' % index)
+        return self.batch[index - self.start]
+
+    def count(self, *args, **kwords):
+        return self.cursor.count(*args, **kwords)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+
 class AuthSchemaCursorWrapper(SchemaCursorWrapper):
-    def __init__(self, cursor, db, endpoint, user=None):
-        self._cache = None
-        SchemaCursorWrapper.__init__(self, cursor, db, endpoint['schema'])
+    """
+    Lazy cursor - the query is read once, batch_size documents at a time,
+    authstates are resolved per batch, and only read-permitted documents are
+    yielded.  skip and limit count readable documents.  Readable documents
+    are counted in the same pass, so total only reads what the page didn't.
+    With server_paged, the query itself was skipped and limited (every
+    document it matches being readable) and total is the server's count.
+    The page's documents are kept as they are read (unless retain is off),
+    so the cursor can be iterated again and indexed without a new query.
+    """
+    batch_size = 100
+    retain = True
+
+    def __init__(self, cursor, db, endpoint, user=None, skip=0, limit=0, proj=None, server_paged=False):
         self.endpoint = endpoint
+        self.proj = proj
         self.user = user
-        self._cache = self.all()
-        for item in self._cache:
-            add_authstates(self.endpoint, item, self.user)
-        self._cache = filter(lambda doc: doc._authstate['_read'], self._cache)
-        
+        self.skip = skip
+        self.limit = limit
+        self.server_paged = server_paged
+        self._source = cursor
+        self._batches = None
+        self._stream = None         # read-permitted documents, in one pass over the query
+        self._seen = 0              # read-permitted documents read so far
+        self._items = []            # page documents read so far
+        self._done = False
+        self._total = None
+        self._memo = {}
+        SchemaCursorWrapper.__init__(self, cursor, db, endpoint['schema'])
+
+    @timed('fetch')
+    def _fetch(self):
+        if self._batches is None:
+            self._batches = BatchedCursor(self._source.cursor, self.batch_size)
+            self._source.cursor = self._batches
+        return [SchemaCursorWrapper.__getitem__(self, i) for i in self._batches.next_batch()]
+
+    def _read_permitted(self):
+        while True:
+            batch = self._fetch()
+            if not batch:
+                return
+            for item in batch:
+                add_authstates(self.endpoint, item, memo=self._memo, proj=self.proj)
+            for item in batch:
+                if item._authstate['_read']:
+                    self._seen += 1
+                    yield item
+
+    def _next(self):
+        """Reads the next document of the page - None past its end"""
+        if self._done:
+            return None
+        if self._stream is None:
+            self._stream = self._read_permitted()
+        for item in self._stream:
+            if not self.server_paged:
+                if self._seen <= self.skip:
+                    continue
+                if self.limit and self._seen > self.skip + self.limit:
+                    break
+            enforce_auth_read(self.endpoint, item)
+            if self.retain:
+                self._items.append(item)
+            return item
+        self._done = True
+        return None
+
+    @property
+    def total(self):
+        """Number of readable documents, ignoring skip and limit"""
+        if self._total is None and self.server_paged:
+            self._total = self._server_count()
+        if self._total is None:
+            while self._next() is not None:
+                pass
+            for item in self._stream:
+                pass
+            self._total = self._seen
+        return self._total
+
+    @timed('count')
+    def _server_count(self):
+        return self._source.cursor.count()         # pymongo's count ignores skip and limit
+
     def count(self):
-        if not self._cache:
-            return SchemaCursorWrapper.count(self)
-        return len(self._cache)
+        result = max(self.total - self.skip, 0)
+        if self.limit:
+            result = min(result, self.limit)
+        return result
 
     def __getitem__(self, index):
-        if not self._cache:
-            return SchemaCursorWrapper.__getitem__(self, index)
-        tmp = self._cache[index]
-        enforce_auth_read(self.endpoint, tmp)
-        return tmp
-    
-    def __iter__(self):
-        return AuthSchemaCursorWrapperIter(self)
-    
+        if index < 0:
+            index += self.count()
+        if index >= 0:
+            for i, item in enumerate(self):
+                if i == index:
+                    return item
+        raise IndexError('cursor index out of range')
 
-class AuthSchemaCursorWrapperIter():
-    def __init__(self, wrapper):
-        self.wrapper = wrapper
-        self.i = -1
-        
     def __iter__(self):
-        return self
-    
-    def next(self):
-        if self.i < len(self.wrapper._cache)-1:
-            self.i += 1         
-            tmp = self.wrapper._cache[self.i]
-            enforce_auth_read(self.wrapper.endpoint, tmp)
-            return tmp
-        else:
-            raise StopIteration
+        i = 0
+        while True:
+            if i < len(self._items):
+                item = self._items[i]
+            else:
+                item = self._next()
+                if item is None:
+                    return
+            i += 1
+            yield item
 
+    def all(self):
+        return list(self)
@@ -0,0 +1,65 @@
+"""
+Optional per-request timing of the hot path.
+
+Functions decorated with timed(name) add their wall time to the current
+request's timings, which create_app's hooks turn into a Server-Timing
+header and a log line when the TIMING config value is set.  Recursive
+calls are counted once, in the outermost call.  Until some app enables
+timing, a timed function costs one extra call and a global check.
+It lives in auth_layer so that package doesn't depend on the app.
+"""
+import functools
+import logging
+import threading
+import time
+
+
+enabled = False
+log = logging.getLogger('flipserver.timing')
+_local = threading.local()
+
+
+def start():
+    _local.timings = {}
+    _local.active = set()
+
+
+def stop():
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def record(name, seconds):
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return
+    entry = timings.setdefault(name, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += 1
+
+
+def timed(name):
+    def decorator(fcn):
+        @functools.wraps(fcn)
+        def wrapper(*args, **kwords):
+            if not enabled or getattr(_local, 'timings', None) is None or name in _local.active:
+                return fcn(*args, **kwords)
+            _local.active.add(name)
+            begin = time.time()
+            try:
+                return fcn(*args, **kwords)
+            finally:
+                _local.active.discard(name)
+                record(name, time.time() - begin)
+        return wrapper
+    return decorator
+
+
+def header(timings):
+    return ', '.join('%s;dur=%.3f' % (name, timings[name][0] * 1000) for name in sorted(timings))
+
+
+def summary(timings):
+    return dict((name, {'ms': round(val[0] * 1000, 3), 'calls': val[1]})
+                for name, val in timings.items())
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding at most size entries, least recently used
+    evicted first.  Entries older than ttl seconds are treated as missing.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stamp = self._data.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - stamp > self.ttl:
+                return default
+            self._data[key] = (value, stamp)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+
+class ResponseCache(object):
+    """
+    LRU cache of serialized responses, bounded by the total size of the
+    bodies in bytes.  Each entry records the collections it depends on and
+    their write versions when it was built - a lookup with different
+    versions is a miss, so writes from other processes are honored too.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[1] != versions:
+                if entry is not None:
+                    self.bytes -= len(entry[2])
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, deps, versions, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[2])
+            self._data[key] = (deps, versions, body)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                key, old = self._data.popitem(last=False)
+                self.bytes -= len(old[2])
+
+    def invalidate(self, collection):
+        """Drops every entry depending on collection"""
+        with self._lock:
+            for key, entry in list(self._data.items()):
+                if collection in entry[0]:
+                    del self._data[key]
+                    self.bytes -= len(entry[2])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+            'bytes': self.bytes,
+        }
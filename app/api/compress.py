@@ -0,0 +1,86 @@
+"""
+Negotiated gzip/deflate compression of API responses, as an after_request
+hook of the API blueprint.
+
+Responses of at least COMPRESS_MIN_SIZE bytes (default 1024) are
+compressed at COMPRESS_LEVEL (default 6) when the client accepts it.
+Streamed responses are compressed as they are sent, flushing whenever
+STREAM_FLUSH_SIZE bytes have gone in so items keep arriving
+progressively.  Time spent compressing is recorded in the request's
+timings and in the compress_* metrics counters.
+"""
+import time
+import zlib
+from flask import request, current_app
+from auth_layer import timing
+
+
+ENCODINGS = ('gzip', 'deflate')
+STREAM_FLUSH_SIZE = 16384
+
+
+def compressor(encoding, level):
+    wbits = zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def record(metrics, seconds, size_in, size_out):
+    timing.record('compress', seconds)
+    if metrics is not None:
+        metrics.add('flipserver_compress_seconds_total', seconds)
+        metrics.add('flipserver_compress_in_bytes_total', size_in)
+        metrics.add('flipserver_compress_out_bytes_total', size_out)
+
+
+def compress_stream(chunks, encoding, level, metrics=None):
+    comp = compressor(encoding, level)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        begin = time.time()
+        out = comp.compress(chunk)
+        pending += len(chunk)
+        if pending >= STREAM_FLUSH_SIZE:
+            out += comp.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        record(metrics, time.time() - begin, len(chunk), len(out))
+        if out:
+            yield out
+    begin = time.time()
+    out = comp.flush()
+    record(metrics, time.time() - begin, 0, len(out))
+    yield out
+
+
+def compress_response(response):
+    config = current_app.config
+    if (not config.get('COMPRESS', True) or request.method == 'HEAD'
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.direct_passthrough):
+        return response
+    if not response.is_streamed:
+        data = response.get_data()
+        if len(data) < config.get('COMPRESS_MIN_SIZE', 1024):
+            return response
+        # views return shared module-level responses, which must not be changed in place
+        response = current_app.response_class(data, status=response.status_code, headers=list(response.headers))
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+
+    level = config.get('COMPRESS_LEVEL', 6)
+    metrics = getattr(current_app, 'metrics', None)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level, metrics)
+        response.headers.pop('Content-Length', None)
+    else:
+        begin = time.time()
+        comp = compressor(encoding, level)
+        body = comp.compress(data) + comp.flush()
+        record(metrics, time.time() - begin, len(data), len(body))
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,50 @@
+"""
+Pluggable JSON encoding for API requests and responses, picked with the
+JSON_BACKEND app config value:
+
+    'flask' - flask.json with the app's encoder and decoder (default)
+    'fast'  - the stdlib C encoder with compact separators, unsorted keys and
+              no circular check, for the plain dict/list/str/int/datetime
+              shapes that get_serial_dict produces
+"""
+import json as stdjson
+import uuid
+from datetime import date, datetime
+from flask import current_app, json as flask_json
+from werkzeug.http import http_date
+from auth_layer.timing import timed
+
+
+def _default(o):
+    # Same conversions as flask's JSONEncoder
+    if isinstance(o, datetime):
+        return http_date(o.utctimetuple())
+    if isinstance(o, date):
+        return http_date(o.timetuple())
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return unicode(o.__html__())
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+
+_fast_encoder = stdjson.JSONEncoder(default=_default, separators=(',', ':'), check_circular=False)
+
+
+BACKENDS = {
+    'flask': (flask_json.dumps, flask_json.loads),
+    'fast': (_fast_encoder.encode, stdjson.loads),
+}
+
+
+def backend():
+    return BACKENDS[current_app.config.get('JSON_BACKEND', 'flask')]
+
+
+@timed('json')
+def dumps(obj):
+    return backend()[0](obj)
+
+
+def loads(s):
+    return backend()[1](s)
@@ -0,0 +1,157 @@
+"""
+Request counters and latency histograms for the API routes, rendered in
+the Prometheus text format by create_app's /metrics route.
+
+Each thread records into a shard of its own, so recording a request takes
+no lock; a scrape sums the shards.  The lock is only taken when a thread
+records for the first time and when scraping.  The shards of finished
+threads are then folded into a single retired shard, so the counters stay
+monotonic without keeping a shard per thread ever served.  Other code can
+keep named counters with add().
+"""
+import bisect
+import threading
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def route_labels(endpoint):
+    """'api.users_api_item' -> ('users', 'item'), None outside the API"""
+    if not endpoint or not endpoint.startswith('api.'):
+        return None
+    name, sep, route = endpoint[4:].rpartition('_api_')
+    if not sep:
+        return None
+    return name, route
+
+
+def merge(into, shard):
+    """Adds shard's requests and counters into the shard into"""
+    requests, counters = shard
+    for labels, (count, total, counts) in requests.items():
+        entry = into[0].setdefault(labels, [0, 0.0, [0] * len(counts)])
+        entry[0] += count
+        entry[1] += total
+        entry[2] = [a + b for a, b in zip(entry[2], counts)]
+    for name, value in counters.items():
+        into[1][name] = into[1].get(name, 0) + value
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(val)) for name, val in zip(names, values))
+
+
+
+class Metrics(object):
+    labels = ('endpoint', 'route', 'method', 'status')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = {}               # thread ident -> (thread, shard)
+        self._retired = ({}, {})        # the shards of finished threads, merged
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        """(requests by labels, counters by name) of the current thread"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            thread = threading.current_thread()
+            with self._lock:
+                self._retire()
+                self._shards[thread.ident] = (thread, shard)
+            return shard
+
+    def _retire(self):
+        """Folds the shards of finished threads into _retired - called with the lock held"""
+        for ident, (thread, shard) in list(self._shards.items()):
+            if not thread.is_alive():
+                merge(self._retired, shard)
+                del self._shards[ident]
+
+    def add(self, name, value):
+        """Adds value to the counter name"""
+        counters = self._shard()[1]
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, labels, seconds):
+        """Records one request with the given label values and duration"""
+        shard = self._shard()[0]
+        entry = shard.get(labels)
+        if entry is None:
+            entry = shard[labels] = [0, 0.0, [0] * (len(self.buckets) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def _snapshot(self):
+        result = ({}, {})
+        with self._lock:
+            self._retire()
+            merge(result, self._retired)
+            shards = [shard for thread, shard in self._shards.values()]
+        for shard in shards:
+            merge(result, shard)
+        return result
+
+    def collect(self):
+        """{labels: [count, sum, per-bucket counts]} summed over all threads"""
+        return self._snapshot()[0]
+
+    def counters(self):
+        """{name: value} of the counters, summed over all threads"""
+        return self._snapshot()[1]
+
+    def render(self):
+        """Prometheus text format lines - request counts by status, and latency by method"""
+        data = self.collect()
+        lines = [
+            '# HELP flipserver_requests_total API requests by endpoint, route, method and status.',
+            '# TYPE flipserver_requests_total counter',
+        ]
+        for labels in sorted(data):
+            lines.append('flipserver_requests_total%s %d' % (format_labels(self.labels, labels), data[labels][0]))
+
+        latency = {}
+        for labels, (count, total, counts) in data.items():
+            entry = latency.setdefault(labels[:3], [0, 0.0, [0] * len(counts)])
+            entry[0] += count
+            entry[1] += total
+            entry[2] = [a + b for a, b in zip(entry[2], counts)]
+
+        lines += [
+            '# HELP flipserver_request_duration_seconds API request latency by endpoint, route and method.',
+            '# TYPE flipserver_request_duration_seconds histogram',
+        ]
+        names = self.labels[:3]
+        for labels in sorted(latency):
+            count, total, counts = latency[labels]
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('flipserver_request_duration_seconds_bucket%s %d' % (
+                    format_labels(names + ('le',), labels + (bound,)), cumulative))
+            lines.append('flipserver_request_duration_seconds_sum%s %r' % (format_labels(names, labels), total))
+            lines.append('flipserver_request_duration_seconds_count%s %d' % (format_labels(names, labels), count))
+
+        for name, value in sorted(self.counters().items()):
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %r' % (name, value))
+        return lines
+
+
+def cache_lines(prefix, stats):
+    """Prometheus lines for a ResponseCache.stats() dict"""
+    lines = []
+    for key, kind in (('hits', 'counter'), ('misses', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')):
+        name = '%s_%s' % (prefix, key + '_total' if kind == 'counter' else key)
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %d' % (name, stats[key]))
+    return lines
@@ -1,5 +1,10 @@
-from flask import abort, request, Response, json
+import base64
+import hashlib
+from flask import abort, request, Response, json, stream_with_context, current_app
 from jinja2.exceptions import TemplateNotFound
+from auth_layer.auth_doc import is_read_filter, auth_arity, restricted_paths
+from auth_layer.database import pipeline_refs
+from jsonio import dumps, loads
 
 
 
@@ -44,6 +49,8 @@ NOT_ALLOWED = Response(
 def resolve_auth(key, endpoint):
     auth = endpoint.get('auth', {})
     auth = auth.get(key, True)
+    if is_read_filter(auth):          # applied per query instead
+        return True
     if callable(auth):
         try:
             auth = auth()
@@ -54,31 +61,184 @@ def resolve_auth(key, endpoint):
     return auth
 
 
+def current_user():
+    return getattr(request, 'user', None)
+
+
+def request_key(collection_name, *parts):
+    """Identifies a GET's response - endpoint, user and normalized arguments"""
+    user = current_user()
+    return json.dumps([collection_name, user and user.get('_id'),
+                       sorted(request.args.items(multi=True))] + list(parts))
+
+
+def request_deps(db, collection_name):
+    """Collections whose writes can change a response of this endpoint"""
+    deps = db.dependencies[collection_name]
+    if current_user() is not None:
+        deps = deps + ['users']
+    return deps
+
+
+def check_etag(db, collection_name, key):
+    """
+    (versions, etag, 304 response or None) when ETAGS is configured, else
+    all None.  Computed before any document is read.
+    """
+    if not current_app.config.get('ETAGS', False):
+        return None, None, None
+    versions = db.versions(request_deps(db, collection_name))
+    etag = hashlib.sha1(json.dumps([key, versions])).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        return versions, etag, tagged(Response(status=304), etag)
+    return versions, etag, None
+
+
+def tagged(resp, etag):
+    if etag:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+def parse_sort(arg):
+    """sort=[["field", 1], ["other", -1]] -> pymongo sort list"""
+    sort = loads(arg)
+    if sort is None:
+        return None
+    if not isinstance(sort, list):
+        raise ValueError('sort must be a list of [field, direction] pairs')
+    result = []
+    for key, direction in sort:
+        if direction not in (1, -1):
+            raise ValueError('sort direction must be 1 or -1')
+        result.append((key, direction))
+    return result or None
+
+
+def parse_paging(args):
+    skip = int(args.get('skip', 0))
+    limit = int(args.get('limit', 0))
+    if skip < 0 or limit < 0:
+        raise ValueError('skip and limit must be non-negative')
+    return skip, limit
+
+
+def parse_flag(args, name):
+    """name=1/true -> True, name=0/false or absent -> False"""
+    value = args.get(name, 'false').lower()
+    if value not in ('1', 'true', '0', 'false'):
+        raise ValueError('%s must be 1, true, 0 or false' % name)
+    return value in ('1', 'true')
+
+
+def parse_after(args):
+    """
+    Keyset paging position - after=<_id> (after=0 for the first page) or the
+    opaque cursor token of a previous page's _meta.next.  None without either.
+    """
+    if 'cursor' in args:
+        after = loads(base64.urlsafe_b64decode(str(args['cursor'])))['after']
+    elif 'after' in args:
+        after = args['after']
+    else:
+        return None
+    return int(after)
+
+
+def next_token(after):
+    return base64.urlsafe_b64encode(dumps({'after': after}))
+
+
+def stream_list(coll, cursor, auth, paged):
+    """Yields the list envelope, then each item serialized as the cursor produces it"""
+    cursor.retain = False           # items are sent as they are read, not kept
+    yield '{"_status": "OK", "_auth": %s, "_items": [' % dumps(auth)
+    sep = ''
+    for item in cursor:
+        yield sep + dumps(coll.get_serial_dict(item))
+        sep = ', '
+    yield ']'
+    if paged:
+        yield ', "_meta": %s' % dumps({'total': cursor.total, 'skip': cursor.skip, 'limit': cursor.limit})
+    yield '}'
+
+
 
 def api_list_view_factory(db, collection_name):
     
     def view_fcn():
         endpoint = db.endpoints[collection_name]
+        coll = db[collection_name]
         
-        if request.method == 'GET':
+        if request.method in ('GET', 'HEAD'):
             if not resolve_auth('read', endpoint):
                 return UNAUTHORIZED
 
             try:
-                spec = json.loads(request.args.get('q', "{}"))
-                fields = json.loads(request.args.get('fields', 'null'))
+                spec = loads(request.args.get('q', "{}"))
+                fields = loads(request.args.get('fields', 'null'))
+                sort = parse_sort(request.args.get('sort', 'null'))
+                skip, limit = parse_paging(request.args)
+                after = parse_after(request.args)
+                count_only = parse_flag(request.args, 'count')
             except:
                 return MALFORMED
+            if after is not None:
+                if sort or skip:            # keyset paging walks _id order
+                    return MALFORMED
+                spec = {'$and': [spec, {'_id': {'$gt': after}}]}
+                sort = [('_id', 1)]
+
+            key = request_key(collection_name)
+            versions, etag, not_modified = check_etag(db, collection_name, key)
+            if not_modified:
+                return not_modified
+
+            if request.method == 'HEAD' or count_only:
+                count = coll.count(spec, user=current_user())
+                body = '' if request.method == 'HEAD' else dumps({'_status':'OK', '_count':count})
+                resp = Response(body, content_type='application/json')
+                resp.headers['X-Total-Count'] = str(count)
+                return tagged(resp, etag)
+
+            cache = current_app.response_cache
+            streaming = request.args.get('stream') and after is None
+            if cache is not None and not streaming:
+                deps = request_deps(db, collection_name)
+                versions = versions or db.versions(deps)
+                body = cache.get(key, versions)
+                if body is not None:
+                    return tagged(Response(body, content_type='application/json'), etag)
             
-            data = db[collection_name].find_and_serial_dict(spec, fields)
+            keyset = after is not None and limit
+            # one extra document tells whether there is a next page
+            cursor = coll.find(spec, fields, skip, limit + 1 if keyset else limit, sort, user=current_user())
+            paged = 'skip' in request.args or 'limit' in request.args
+
+            if streaming:
+                body = stream_list(coll, cursor, resolve_auth('create', endpoint), paged)
+                return tagged(Response(stream_with_context(body), content_type='application/json'), etag)
+
+            items = list(cursor)
+            more = bool(keyset) and len(items) > limit
+            if more:
+                del items[limit:]
+            data = [coll.get_serial_dict(x) for x in items]
 
             resp = {'_status':'OK', '_items':data, '_auth': resolve_auth('create', endpoint)}
-            return Response(json.dumps(resp), content_type='application/json')
+            if after is not None:
+                resp['_meta'] = {'limit': limit, 'next': next_token(items[-1]['_id']) if more else None}
+            elif paged:
+                resp['_meta'] = {'total': cursor.total, 'skip': skip, 'limit': limit}
+            body = dumps(resp)
+            if cache is not None:
+                cache.set(key, deps, versions, body)
+            return tagged(Response(body, content_type='application/json'), etag)
 
 
         elif request.method == 'POST':
             try:
-                incoming = json.loads(request.data)
+                incoming = loads(request.data)
             except:
                 return MALFORMED
 
@@ -92,23 +252,68 @@ def api_list_view_factory(db, collection_name):
                 name = username=request.user.username
             except AttributeError:
                 name = None
-            ids, errs = db[collection_name].insert(incoming, username=name)
+            ids, errs = coll.insert(incoming, username=name)
             
             if errs:
                 resp = {'_status':'ERR', 'message': 'Field errors'}
                 resp['field_errors'] = errs
-                return Response(json.dumps(resp), content_type='application/json')
+                return Response(dumps(resp), content_type='application/json')
             else:
 
                 resp = {'_status':'OK'}
-                items = [db[collection_name].find_one_and_serial_dict(x) for x in ids]
+                items = [coll.get_serial_dict(x) for x in coll.find_by_ids(ids)]
                 if len(items) == 1:
                     resp['_item'] = items[0]
                 else:
                     resp['_items'] = items
-                return Response(json.dumps(resp), 
+                return Response(dumps(resp), 
                                 status = 201,
                                 content_type='application/json')
+
+        elif request.method == 'PUT':
+            try:
+                incoming = loads(request.data)
+            except:
+                return MALFORMED
+            if not isinstance(incoming, list) or not all(isinstance(x, dict) and x.get('_id') for x in incoming):
+                return MALFORMED
+            ids = [x['_id'] for x in incoming]
+            if len(set(ids)) != len(ids):
+                return MALFORMED
+
+            if coll.load_many(ids, user=current_user()):
+                return NOT_FOUND
+
+            try:
+                name = request.user.username
+            except AttributeError:
+                name = None
+            errs = coll.update_many(incoming, username=name)
+
+            updated = [id for id, err in zip(ids, errs) if not err]
+            items = dict((x['_id'], coll.get_serial_dict(x)) for x in coll.find_by_ids(updated))
+            resp = {'_status':'OK', '_items':[items.get(id) for id in ids]}
+            if any(errs):
+                resp['_status'] = 'ERR'
+                resp['message'] = 'Field errors'
+                resp['field_errors'] = errs
+            return Response(dumps(resp), content_type='application/json')
+
+        elif request.method == 'DELETE':
+            try:
+                spec = loads(request.args['q'])
+            except:
+                return MALFORMED
+            if not isinstance(spec, dict) or not spec:
+                return MALFORMED
+
+            auth = endpoint.get('auth', {}).get('delete', True)
+            if not auth:
+                return UNAUTHORIZED
+
+            ids = coll.remove(spec, check_auth=callable(auth), user=current_user())
+            resp = {'_status':'OK', '_count':len(ids)}
+            return Response(dumps(resp), content_type='application/json')
                 
         else:
             return NOT_ALLOWED
@@ -121,62 +326,115 @@ def api_item_view_factory(db, collection_name):
     
     def view_fcn(id):
         endpoint = db.endpoints[collection_name]
-
-        if not db[collection_name].find({"_id": id}).count():
-            return NOT_FOUND
+        coll = db[collection_name]
 
         if request.method == 'GET':            
             try:
-                fields = json.loads(request.args.get('fields', 'null'))
+                fields = loads(request.args.get('fields', 'null'))
             except:
                 return MALFORMED
 
-            data = db[collection_name].find_one({'_id':id}, fields)
+            versions, etag, not_modified = check_etag(db, collection_name, request_key(collection_name, id))
+            if not_modified:
+                return not_modified
+
+            data = coll.find_one({'_id':id, '_active':True}, fields, user=current_user())
+            if not data:
+                return NOT_FOUND
             
             if not data._authstate['_read']:
                 return UNAUTHORIZED
             
-            resp = {'_status':'OK', '_item':db[collection_name].get_serial_dict(data)}
-            return Response(json.dumps(resp), content_type='application/json')
+            resp = {'_status':'OK', '_item':coll.get_serial_dict(data)}
+            return tagged(Response(dumps(resp), content_type='application/json'), etag)
 
 
-        elif request.method == 'PUT':
+        elif request.method in ('PUT', 'PATCH'):
             try:
-                incoming = json.loads(request.data)
+                incoming = loads(request.data)
             except:
                 return MALFORMED
             
             if '_id' in incoming and incoming['_id'] != id:
                 return WRONG_ID
             incoming.update({'_id':id})
+
+            if not coll.load(id, user=current_user()):
+                return NOT_FOUND
             
             try:
                 name = username=request.user.username
             except AttributeError:
                 name = None
-            errs = db[collection_name].update(incoming, username=name)
+            if request.method == 'PATCH':       # writes only the changed paths
+                errs = coll.patch(incoming, username=name)
+            else:
+                errs = coll.update(incoming, username=name)
 
             if errs:
                 resp = {'_status':'ERR', 'message': 'Field errors'}
                 resp['field_errors'] = errs
-                return Response(json.dumps(resp), content_type='application/json')
+                return Response(dumps(resp), content_type='application/json')
             else:
+                data = coll.find_one(id, user=current_user())
                 resp = {'_status':'OK',
-                        '_item': db[collection_name].find_one_and_serial_dict(id)
+                        '_item': data and coll.get_serial_dict(data)
                        }
-                return Response(json.dumps(resp), 
+                return Response(dumps(resp), 
                                 status = 200,
                                 content_type='application/json')
 
         elif request.method == 'DELETE':
-            data = db[collection_name].find_one({'_id':id})
+            data = coll.load(id, user=current_user())
+            if not data:
+                return NOT_FOUND
             if not data._authstate['_delete']:
                 return UNAUTHORIZED
             
-            db[collection_name].remove({"_id": id})
+            coll.remove(id, user=current_user())      # reuses the document loaded above
             return Response(status=204)
         
         else:
             return NOT_ALLOWED
  
     return view_fcn
+
+
+
+def is_restricted(path, restricted):
+    for prefix in restricted:
+        if path == prefix or path.startswith(prefix + '.') or prefix.startswith(path + '.'):
+            return True
+    return False
+
+
+def api_aggregate_view_factory(db, collection_name):
+    
+    def view_fcn():
+        endpoint = db.endpoints[collection_name]
+        coll = db[collection_name]
+
+        auth = endpoint.get('auth', {}).get('read', True)
+        if callable(auth) and not is_read_filter(auth) and auth_arity(auth) != 0:
+            return NOT_ALLOWED          # per-document read auth can't be put in a $match
+        if not resolve_auth('read', endpoint):
+            return UNAUTHORIZED
+
+        try:
+            pipeline = loads(request.args['pipeline'])
+            refs = pipeline_refs(pipeline)
+        except:
+            return MALFORMED
+
+        restricted = restricted_paths(endpoint)
+        if any(is_restricted(path, restricted) for path in refs):
+            return UNAUTHORIZED
+
+        versions, etag, not_modified = check_etag(db, collection_name, request_key(collection_name, '_aggregate'))
+        if not_modified:
+            return not_modified
+
+        resp = {'_status':'OK', '_items':coll.aggregate(pipeline, user=current_user())}
+        return tagged(Response(dumps(resp), content_type='application/json'), etag)
+
+    return view_fcn
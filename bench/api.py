@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Throughput and latency benchmarks for the API hot paths, driven through
+create_app's test client against mongomock.  Run from the repository root:
+
+    python -m bench.api [--size N] [--depth D] [--width W] [--ops N]
+                        [--out FILE] [--compare FILE]
+
+Results are written as JSON (bench/results/<commit>.json by default) so
+runs from different commits can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import timeit
+
+import mongomock
+from app import create_app
+
+
+def subdoc_schema(depth, width):
+    schema = {
+        'name': {'type': 'string'},
+        'value': {'type': 'integer'},
+    }
+    if depth > 0:
+        schema['items'] = {'type': 'list', 'schema': {'type': 'dict',
+            'auth': {
+                'edit': lambda e: e.value % 3 != 0,
+                'delete': lambda e: e.value % 2 == 0,
+            },
+            'schema': subdoc_schema(depth - 1, width),
+        }}
+    return schema
+
+
+def endpoints(depth, width):
+    return {
+        'bench': {
+            'auth': {
+                'read': lambda e: e.value % 10 != 0,
+                'create': lambda: True,
+            },
+            'schema': subdoc_schema(depth, width),
+        }
+    }
+
+
+def make_doc(i, depth, width):
+    doc = {'name': 'doc%d' % i, 'value': i}
+    if depth > 0:
+        doc['items'] = [make_doc(j, depth - 1, width) for j in range(width)]
+    return doc
+
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[int(round(p / 100.0 * (len(times) - 1)))]
+
+
+def check(resp):
+    assert resp.status_code < 300, resp.data
+    if resp.data:
+        assert json.loads(resp.data)['_status'] == 'OK', resp.data
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fcn, ops):
+    """
+    ops calls of fcn.  ru_maxrss is a process-wide high-water mark, so the
+    memory figure is how far this scenario raised it - 0 when it stayed
+    under the peak of the scenarios before it.
+    """
+    times = []
+    rss = max_rss()
+    for i in range(ops):
+        start = timeit.default_timer()
+        resp = fcn(i)
+        times.append(timeit.default_timer() - start)
+        check(resp)
+    return {
+        'ops_per_sec': len(times) / sum(times),
+        'p50_ms': percentile(times, 50) * 1000,
+        'p99_ms': percentile(times, 99) * 1000,
+        'peak_rss_growth_kb': max_rss() - rss,
+    }
+
+
+def scenarios(client, size, depth, width):
+    headers = {'content_type': 'application/json'}
+
+    def put_embedded(i):
+        doc = make_doc(i, depth, width)
+        doc['_id'] = i + 1
+        if depth > 0:
+            doc['items'] = [dict(x, _id=j + 2, name='edited') for j, x in enumerate(doc['items'][1:])]
+            doc['items'].append(make_doc(0, depth - 1, width))
+        return client.put('/api/bench/%d' % (i + 1), data=json.dumps(doc), **headers)
+
+    readable = [i + 1 for i in range(size) if i % 10]
+
+    return [
+        ('list_get', lambda i: client.get('/api/bench')),
+        ('list_get_page', lambda i: client.get('/api/bench?limit=50&skip=%d' % (i % max(size - 50, 1)))),
+        ('item_get', lambda i: client.get('/api/bench/%d' % random.choice(readable))),
+        ('post_single', lambda i: client.post('/api/bench',
+                                              data=json.dumps(make_doc(i, depth, width)), **headers)),
+        ('post_batch', lambda i: client.post('/api/bench',
+                                             data=json.dumps([make_doc(j, depth, width) for j in range(50)]),
+                                             **headers)),
+        ('put_embedded', put_embedded),
+        ('delete', lambda i: client.delete('/api/bench/%d' % (size - i))),
+    ]
+
+
+def run(size=1000, depth=2, width=5, ops=50):
+    random.seed(0)
+    app = create_app(CLIENT=mongomock.MongoClient(), ENDPOINTS=endpoints(depth, width))
+    client = app.test_client()
+    for start in range(0, size, 500):
+        ids, errs = app.db.bench.insert([make_doc(i, depth, width)
+                                         for i in range(start, min(start + 500, size))])
+        assert not errs, errs
+
+    results = {}
+    for name, fcn in scenarios(client, size, depth, width):
+        count = ops if name not in ('list_get', 'post_batch') else max(ops // 10, 1)
+        results[name] = measure(fcn, min(count, size))
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, previous):
+    print('%-14s %14s %14s %10s' % ('scenario', 'ops/sec', 'previous', 'change'))
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        new, old = results[name]['ops_per_sec'], previous[name]['ops_per_sec']
+        print('%-14s %14.1f %14.1f %+9.1f%%' % (name, new, old, (new / old - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API hot path benchmarks')
+    parser.add_argument('--size', type=int, default=1000, help='documents seeded')
+    parser.add_argument('--depth', type=int, default=2, help='embedded list nesting depth')
+    parser.add_argument('--width', type=int, default=5, help='items per embedded list')
+    parser.add_argument('--ops', type=int, default=50, help='operations per scenario')
+    parser.add_argument('--out', help='results file')
+    parser.add_argument('--compare', help='previous results file')
+    args = parser.parse_args()
+
+    results = run(args.size, args.depth, args.width, args.ops)
+    report = {
+        'commit': commit(),
+        'config': {'size': args.size, 'depth': args.depth, 'width': args.width, 'ops': args.ops},
+        'results': results,
+    }
+
+    out = args.out or os.path.join('bench', 'results', '%s.json' % report['commit'])
+    if not os.path.isdir(os.path.dirname(out) or '.'):
+        os.makedirs(os.path.dirname(out))
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name in sorted(results):
+        r = results[name]
+        print('%-14s %10.1f ops/s  p50 %8.2f ms  p99 %8.2f ms  peak rss +%8d kB' % (
+            name, r['ops_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_rss_growth_kb']))
+    print('written to %s' % out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
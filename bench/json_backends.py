@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Compares the JSON_BACKEND encoders and decoders on a list GET shaped
+payload.  Run from the repository root:
+
+    python -m bench.json_backends [items] [repeat]
+"""
+import sys
+import datetime
+import timeit
+
+from flask import Flask
+from app.api import jsonio
+
+
+def payload(items):
+    now = datetime.datetime(2014, 1, 1, 12, 0, 0)
+    return {
+        '_status': 'OK',
+        '_auth': True,
+        '_items': [{
+            '_id': i,
+            '_auth': {'_edit': True, '_delete': True, 'roles': True},
+            'username': 'user%d' % i,
+            'active': i % 2 == 0,
+            'created': now,
+            'roles': [{
+                '_id': j,
+                '_auth': {'_edit': True, '_delete': False},
+                'name': 'role%d' % j,
+                'level': j,
+            } for j in range(5)],
+        } for i in range(items)],
+    }
+
+
+def run(items=1000, repeat=20):
+    app = Flask(__name__)
+    data = payload(items)
+    results = {}
+    with app.app_context():
+        for name in sorted(jsonio.BACKENDS):
+            dumps, loads = jsonio.BACKENDS[name]
+            encoded = dumps(data)
+            results[name] = {
+                'dumps': min(timeit.repeat(lambda: dumps(data), number=1, repeat=repeat)),
+                'loads': min(timeit.repeat(lambda: loads(encoded), number=1, repeat=repeat)),
+                'bytes': len(encoded),
+            }
+    return results
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:3]]
+    results = run(*args)
+    for name in sorted(results):
+        result = results[name]
+        print('%-6s dumps %8.2f ms  loads %8.2f ms  %9d bytes' % (
+            name, result['dumps'] * 1000, result['loads'] * 1000, result['bytes']))
@@ -851,4 +851,283 @@ class AuthLayerTests(TestCase):
             "doclist2": [],
             "ref2": None,
             "reflist2": [],    
-        })
\ No newline at end of file
+        })
+
+    def test_lazy_cursor(self):
+        self.db.register_endpoint('test', {
+            'auth': {
+                'read': lambda e: e.name != 'Fred'
+            },
+            'schema': {
+                "name": {"type": "string"},
+            }
+        })
+
+        data = [
+            {"name": "Bob"},
+            {"name": "Fred"},
+            {"name": "George"},
+            {"name": "Fred"},
+            {"name": "Harry"},
+        ]
+        ids, errs = self.db.test.insert(data, self.user)
+        self.assertIsNone(errs)
+
+        cursor = self.db.test.find()
+        cursor.batch_size = 2
+        self.assertEqual([x.name for x in cursor], ['Bob', 'George', 'Harry'])
+        self.assertEqual(cursor.count(), 3)
+        self.assertEqual(cursor[1].name, 'George')
+        self.assertEqual([x.name for x in cursor], ['Bob', 'George', 'Harry'])   # kept, not re-read
+        self.assertEqual(cursor._batches.start, 5)
+
+        cursor = self.db.test.find()
+        cursor.batch_size = 2
+        cursor.retain = False
+        self.assertEqual([x.name for x in cursor], ['Bob', 'George', 'Harry'])
+        self.assertEqual(cursor.total, 3)
+        self.assertEqual(cursor.all(), [])
+
+        cursor = self.db.test.find(skip=1, limit=1)
+        cursor.batch_size = 2
+        self.assertEqual([x.name for x in cursor], ['George'])
+        self.assertEqual(cursor.count(), 1)
+        self.assertEqual(cursor.total, 3)
+
+        ids, errs = self.db.users.insert([{'username': 'fred'}, {'username': 'george'}])
+        cursor = self.db.users.find(skip=1, limit=1)
+        self.assertTrue(cursor.server_paged)
+        self.assertEqual([x.username for x in cursor], ['fred'])
+        self.assertEqual(cursor.total, 3)
+        self.assertEqual(cursor.count(), 1)
+
+
+    def test_find_by_ids(self):
+        self.db.register_endpoint('test', {
+            'auth': {
+                'read': lambda e: e.name != 'Fred'
+            },
+            'schema': {
+                "name": {"type": "string"},
+            }
+        })
+
+        data = [
+            {"name": "Bob"},
+            {"name": "Fred"},
+            {"name": "George"},
+        ]
+        ids, errs = self.db.test.insert(data, self.user)
+        self.assertIsNone(errs)
+
+        data = self.db.test.find_by_ids([3, 1, 2, 7])
+        self.assertEqual([x.name for x in data], ['George', 'Bob', 'Fred'])
+        self.assertEqual([x._authstate['_read'] for x in data], [True, True, False])
+
+
+    def test_zero_arg_auth_memo(self):
+        calls = []
+        def can_edit():
+            calls.append(1)
+            return False
+
+        self.db.register_endpoint('test', {
+            'auth': {
+                'edit': can_edit,
+                'read': lambda e: e.name != 'Fred',
+            },
+            'schema': {
+                "name": {"type": "string"},
+            }
+        })
+
+        data = [
+            {"name": "Bob"},
+            {"name": "Fred"},
+            {"name": "George"},
+        ]
+        ids, errs = self.db.test.insert(data, self.user, direct=True)
+        self.assertIsNone(errs)
+
+        del calls[:]
+        data = self.db.test.find().all()
+        self.assertEqual([x.name for x in data], ['Bob', 'George'])
+        self.assertEqual([x._authstate['_edit'] for x in data], [False, False])
+        self.assertEqual(len(calls), 1)
+
+
+    def test_reinsert(self):
+        from app.api.auth_layer.auth_doc import reinsert
+        for restored in ([], [(0, 'a')], [(1, 'a'), (2, 'b')], [(0, 'a'), (5, 'b'), (9, 'c')]):
+            expected = [1, 2, 3]
+            for i, item in restored:
+                expected.insert(i, item)
+            self.assertEqual(reinsert([1, 2, 3], restored), expected)
+
+
+    def test_projection_pruning(self):
+        calls = []
+        def readable(element):
+            calls.append(element.name)
+            return True
+
+        self.db.register_endpoint('test', {
+            'schema': {
+                "name": {"type": "string"},
+                "doclist": {"type": "list", "schema": {"type": "dict",
+                    "auth": {
+                        "read": readable
+                    },
+                    "schema": {
+                        "name": {"type":"string"}
+                    }
+                }},
+            }
+        })
+
+        data = {
+            "name": "Bob",
+            "doclist": [{"name": "Fred"}, {"name": "George"}]
+        }
+        ids, errs = self.db.test.insert(data, self.user)
+        self.assertIsNone(errs)
+
+        del calls[:]
+        data = self.db.test.find(fields=['name']).all()
+        self.assertEqual(calls, [])
+        self.assertNotIn('doclist', data[0]._authstate)
+
+        data = self.db.test.find_one(1, ['doclist'])
+        self.assertEqual(calls, ['Fred', 'George'])
+        self.assertTrue(data._authstate['doclist'])
+
+        from app.api.auth_layer.auth_doc import projection_tree
+        self.assertEqual(projection_tree(None), None)
+        self.assertEqual(projection_tree({'_active': 0}), None)
+        self.assertEqual(projection_tree(['a.b', 'a.c', 'd']), {'a': {'b': None, 'c': None}, 'd': None})
+        self.assertEqual(projection_tree({'a': 1, 'a.b': 1}), {'a': None})
+
+
+    def test_diff_update(self):
+        from app.api.auth_layer.database import diff_update
+        before = {'_id': 1, 'name': 'Bob', 'old': 1, 'obj': {'a': 1, 'b': 2},
+                  'doclist': [{'_id': 1, 'name': 'Fred'}, {'_id': 2, 'name': 'George'}]}
+        after = {'_id': 1, 'name': 'Bob', 'new': 2, 'obj': {'a': 1, 'b': 3},
+                 'doclist': [{'_id': 1, 'name': 'Fred'}, {'_id': 2, 'name': 'Ron'}]}
+        self.assertEqual(diff_update(before, after), (
+            {'$set': {'new': 2, 'obj.b': 3, 'doclist.1.name': 'Ron'}, '$unset': {'old': ''}},
+            {'doclist.1._id': 2},
+        ))
+
+        after['doclist'] = after['doclist'][1:]
+        changes, guards = diff_update(before, after)
+        self.assertEqual(changes['$set']['doclist'], [{'_id': 2, 'name': 'Ron'}])
+        self.assertEqual(guards, {})
+        self.assertEqual(diff_update(before, before), ({}, {}))
+
+
+    def test_patch(self):
+        self.db.register_endpoint('test', {
+            'schema': {
+                'name': {'type': 'string'},
+                'doclist': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+                    'name': {'type': 'string'}
+                }}},
+            }
+        })
+        ids, errs = self.db.test.insert({
+            'name': 'Bob',
+            'doclist': [{'name': 'Fred'}, {'name': 'George'}]
+        })
+        self.assertIsNone(errs)
+        stored = self.db.test.raw.find_one(1)
+
+        coll = self.db.test
+        coll.load(1)
+        self.db.test.raw.update({'_id': 1}, {'$set': {'other': 'untouched'}})
+        errs = coll.patch({'_id': 1, 'doclist': [{'_id': 1, 'name': 'Fred'}, {'_id': 2, 'name': 'Ron'}]})
+        self.assertEqual(errs, [])
+
+        data = self.db.test.raw.find_one(1)
+        self.assertEqual(data['other'], 'untouched')        # not overwritten by a full replace
+        self.assertEqual(data['name'], 'Bob')
+        self.assertEqual([x['name'] for x in data['doclist']], ['Fred', 'Ron'])
+        stored['doclist'][1]['name'] = 'Ron'
+        stored['other'] = 'untouched'
+        self.assertEqual(data, stored)
+
+
+    def test_patch_reshaped_lists(self):
+        self.db.register_endpoint('test', {
+            'schema': {
+                'name': {'type': 'string'},
+                'doclist': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+                    'name': {'type': 'string'}
+                }}},
+            }
+        })
+        doc = {'name': 'Bob', 'doclist': [{'name': 'Fred'}, {'name': 'George'}]}
+        ids, errs = self.db.test.insert([dict(doc), dict(doc)])
+        self.assertIsNone(errs)
+
+        def stored(id):
+            data = self.db.test.raw.find_one(id)
+            data.pop('_id')
+            return data
+
+        def same_as_put(incoming, username=None):
+            self.assertEqual(self.db.test.patch(dict(incoming, _id=1), username=username), [])
+            self.assertEqual(self.db.test.update(dict(incoming, _id=2), username=username), [])
+            self.assertEqual(stored(1), stored(2))
+
+        # an added item
+        same_as_put({'doclist': [{'_id': 1, 'name': 'Fred'}, {'_id': 2, 'name': 'George'}, {'name': 'Ron'}]})
+        self.assertEqual([x['name'] for x in stored(1)['doclist']], ['Fred', 'George', 'Ron'])
+        self.assertTrue(all(x.get('_id') for x in stored(1)['doclist']))
+
+        # a removed item
+        same_as_put({'doclist': [{'_id': 1, 'name': 'Fred'}, {'_id': 3, 'name': 'Ron'}]})
+        self.assertEqual([x['name'] for x in stored(1)['doclist']], ['Fred', 'Ron'])
+
+        # an in-place edit on behalf of a user
+        same_as_put({'name': 'Barney', 'doclist': [{'_id': 1, 'name': 'Wilma'}, {'_id': 3, 'name': 'Ron'}]}, 'bob')
+        self.assertEqual(stored(1)['name'], 'Barney')
+
+        from app.api.auth_layer.database import reshaped
+        before = {'doclist': [{'_id': 1}, {'_id': 2}], 'obj': {'list': []}}
+        self.assertFalse(reshaped(before, {'doclist': [{'_id': 1, 'a': 1}, {'_id': 2}], 'obj': {'list': []}}))
+        self.assertTrue(reshaped(before, {'doclist': [{'_id': 1}], 'obj': {'list': []}}))
+        self.assertTrue(reshaped(before, {'doclist': [{'_id': 1}, {'_id': 2}], 'obj': {'list': [{'a': 1}]}}))
+
+
+    def test_indexes(self):
+        self.db.register_endpoint('test', {
+            'indexes': [
+                'name',
+                [['owner', 1], ['name', -1]],
+                {'keys': ['code'], 'unique': True},
+            ],
+            'schema': {
+                'name': {'type': 'string'},
+                'owner': {'type': 'string'},
+                'code': {'type': 'string'},
+            }
+        })
+        self.assertEqual(self.db.indexes['test'], [
+            ([('_active', 1), ('_id', 1)], {}),
+            ([('name', 1)], {}),
+            ([('owner', 1), ('name', -1)], {}),
+            ([('code', 1)], {'unique': True}),
+        ])
+        self.assertEqual(self.db.index_report('test')['missing'], [keys for keys, options in self.db.indexes['test']])
+
+        self.db.test.raw.create_index([('stale', 1)])
+        reports = self.db.ensure_indexes()
+        self.assertEqual(reports['test']['missing'], [])
+        self.assertEqual(reports['test']['undeclared'], ['stale_1'])
+        self.assertEqual(reports['users']['missing'], [])
+        self.assertEqual(reports['users']['undeclared'], [])
+
+        ids, errs = self.db.test.insert({'name': 'a', 'code': 'x'})
+        self.assertIsNone(errs)
+        self.assertRaises(Exception, self.db.test.raw.insert, {'_id': 99, 'code': 'x'})
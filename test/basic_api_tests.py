@@ -247,6 +247,95 @@ class BasicAPITests(TestCase):
         self.assertEqual(data, {'_id':2, '_active': True, 'username': 'brubble', 'active': True})        
 
 
+    def test_patch_single(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+        ])
+        
+        resp = self.client.patch('/api/users/2',
+                                 data=json.dumps({'active': False}),
+                                 content_type = 'application/json'
+                                 )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_item': {'_id':2, '_auth':{'_edit':True, '_delete':True}, 'username': 'brubble', 'active': False},
+        })
+        data = self.db.users.find_one(2)
+        self.assertEqual(data, {'_id':2, '_active': True, 'username': 'brubble', 'active': False})        
+
+        resp = self.client.patch('/api/users/5',
+                                 data=json.dumps({'active': False}),
+                                 content_type = 'application/json'
+                                 )
+        self.assertEqual(resp.status_code, 404)
+
+
+    def test_put_bulk(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'wflint'},    
+        ])
+        
+        data = [
+            {'_id':3, 'active': False},
+            {'_id':1, 'username': 'fred'},
+        ]
+        resp = self.client.put('/api/users',
+                               data=json.dumps(data),
+                               content_type = 'application/json'
+                               )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_items': [
+                {'_id':3, '_auth':{'_edit':True, '_delete':True}, 'username': 'wflint', 'active': False},
+                {'_id':1, '_auth':{'_edit':True, '_delete':True}, 'username': 'fred', 'active': True},
+            ],
+        })
+        self.assertEqual(self.db.users.find_one(1), {'_id':1, '_active': True, 'username': 'fred', 'active': True})
+        self.assertEqual(self.db.users.find_one(2), {'_id':2, '_active': True, 'username': 'brubble', 'active': True})
+        self.assertEqual(self.db.users.find_one(3), {'_id':3, '_active': True, 'username': 'wflint', 'active': False})
+
+
+    def test_put_bulk_error(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+        ])
+        
+        data = [
+            {'_id':1, 'username': None},
+            {'_id':2, 'active': False},
+        ]
+        resp = self.client.put('/api/users',
+                               data=json.dumps(data),
+                               content_type = 'application/json'
+                               )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'ERR',
+            'message': 'Field errors',
+            'field_errors': [['username: value is required'], []],
+            '_items': [
+                None,
+                {'_id':2, '_auth':{'_edit':True, '_delete':True}, 'username': 'brubble', 'active': False},
+            ],
+        })
+        self.assertEqual(self.db.users.find_one(1), {'_id':1, '_active': True, 'username': 'fflint', 'active': True})
+
+        resp = self.client.put('/api/users',
+                               data=json.dumps([{'_id':1}, {'_id':9}]),
+                               content_type = 'application/json'
+                               )
+        self.assertEqual(resp.status_code, 404)
+
+
     def test_delete_single(self, ):
         self.db.users.insert([
             {'username': 'fflint'},    
@@ -257,3 +346,339 @@ class BasicAPITests(TestCase):
         self.assertEqual(resp.status_code, 204)
         
         self.assertEqual(self.db.users.find().count(), 1)
+
+
+    def test_get_paged_list(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'wflint'},    
+        ])
+
+        resp = self.client.get('/api/users?sort=[["username",1]]&skip=1&limit=1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_auth': True,
+            '_items': [
+                {'_id':1, '_auth':{'_edit':True, '_delete':True}, 'username': 'fflint', 'active': True},
+            ],
+            '_meta': {'total': 3, 'skip': 1, 'limit': 1},
+        })
+
+        resp = self.client.get('/api/users?limit=-1')
+        self.assertEqual(resp.status_code, 400)
+
+
+    def test_get_keyset_list(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'wflint'},    
+        ])
+        self.db.users.remove(2)
+
+        resp = self.client.get('/api/users?after=0&limit=1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([x['_id'] for x in data['_items']], [1])
+        self.assertEqual(data['_meta']['limit'], 1)
+        token = data['_meta']['next']
+
+        resp = self.client.get('/api/users?limit=1&cursor=%s' % token)
+        data = json.loads(resp.data)
+        self.assertEqual(data['_items'], [
+            {'_id':3, '_auth':{'_edit':True, '_delete':True}, 'username': 'wflint', 'active': True},
+        ])
+        self.assertEqual(data['_meta'], {'limit': 1, 'next': None})
+
+        resp = self.client.get('/api/users?after=1')
+        data = json.loads(resp.data)
+        self.assertEqual([x['_id'] for x in data['_items']], [3])
+        self.assertEqual(data['_meta'], {'limit': 0, 'next': None})
+
+        resp = self.client.get('/api/users?after=0&sort=[["username",1]]')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/users?cursor=bogus')
+        self.assertEqual(resp.status_code, 400)
+
+
+    def test_get_count(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'wflint'},    
+        ])
+        self.db.users.remove(2)
+
+        resp = self.client.get('/api/users?count=1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {'_status': 'OK', '_count': 2})
+        self.assertEqual(resp.headers['X-Total-Count'], '2')
+
+        resp = self.client.get('/api/users?count=1&q={"username":"fflint"}')
+        self.assertEqual(json.loads(resp.data)['_count'], 1)
+
+        resp = self.client.get('/api/users?count=true')
+        self.assertEqual(json.loads(resp.data)['_count'], 2)
+        for flag in ('0', 'false'):
+            resp = self.client.get('/api/users?count=' + flag)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(json.loads(resp.data)['_items']), 2)
+        resp = self.client.get('/api/users?count=yes')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.head('/api/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['X-Total-Count'], '2')
+
+
+    def test_get_streamed_list(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+        ])
+
+        resp = self.client.get('/api/users?stream=1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_auth': True,
+            '_items': [
+                {'_id':1, '_auth':{'_edit':True, '_delete':True}, 'username': 'fflint', 'active': True},
+                {'_id':2, '_auth':{'_edit':True, '_delete':True}, 'username': 'brubble', 'active': True},
+            ],
+        })
+
+        resp = self.client.get('/api/users?stream=1&limit=1')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['_items']), 1)
+        self.assertEqual(data['_meta'], {'total': 2, 'skip': 0, 'limit': 1})
+
+
+    def test_delete_list(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'bbrubble'},    
+        ])
+        
+        resp = self.client.delete('/api/users?q={"username":{"$lt":"c"}}')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {'_status': 'OK', '_count': 2})
+        
+        self.assertEqual(self.db.users.find().count(), 1)
+
+        resp = self.client.delete('/api/users')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.db.users.find().count(), 1)
+
+
+    def test_get_etag(self, ):
+        self.app.config['ETAGS'] = True
+        self.db.users.insert([
+            {'username': 'fflint'},    
+        ])
+
+        resp = self.client.get('/api/users')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+
+        resp = self.client.get('/api/users', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get('/api/users?q={"username":"fflint"}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/api/users/1')
+        item_etag = resp.headers['ETag']
+        resp = self.client.get('/api/users/1', headers={'If-None-Match': item_etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.db.users.insert([
+            {'username': 'brubble'},    
+        ])
+        resp = self.client.get('/api/users', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.data)['_items']), 2)
+        resp = self.client.get('/api/users/1', headers={'If-None-Match': item_etag})
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_versions_off(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+        ])
+        self.assertEqual(self.db.versions(['users']), [0])
+        self.app.config['ETAGS'] = True
+        self.db.users.insert([
+            {'username': 'brubble'},    
+        ])
+        self.assertEqual(self.db.versions(['users']), [1])
+
+
+    def test_response_cache(self, ):
+        from app.api import ResponseCache
+        self.app.response_cache = ResponseCache(100000)
+        self.db.users.insert([
+            {'username': 'fflint'},    
+        ])
+
+        resp = self.client.get('/api/users')
+        first = json.loads(resp.data)
+        resp = self.client.get('/api/users')
+        self.assertEqual(json.loads(resp.data), first)
+        self.assertEqual(self.app.response_cache.hits, 1)
+        self.assertEqual(self.app.response_cache.misses, 1)
+
+        self.db.users.insert([
+            {'username': 'brubble'},    
+        ])
+        self.assertEqual(self.app.response_cache.stats()['entries'], 0)
+        resp = self.client.get('/api/users')
+        self.assertEqual(len(json.loads(resp.data)['_items']), 2)
+        self.assertEqual(self.app.response_cache.misses, 2)
+
+        cache = ResponseCache(10)
+        cache.set('a', ['users'], [1], '12345')
+        cache.set('b', ['users'], [1], '123456')
+        self.assertEqual(cache.get('a', [1]), None)
+        self.assertEqual(cache.get('b', [1]), '123456')
+        self.assertEqual(cache.get('b', [2]), None)
+        self.assertEqual(cache.bytes, 0)
+
+
+    def test_fast_json_backend(self, ):
+        self.app.config['JSON_BACKEND'] = 'fast'
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+        ])
+
+        resp = self.client.get('/api/users')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_auth': True,
+            '_items': [
+                {'_id':1, '_auth':{'_edit':True, '_delete':True}, 'username': 'fflint', 'active': True},
+                {'_id':2, '_auth':{'_edit':True, '_delete':True}, 'username': 'brubble', 'active': True},
+            ],
+        })
+
+        resp = self.client.post('/api/users',
+                                data=json.dumps({'username': 'wflint'}),
+                                content_type = 'application/json'
+                                )
+        self.assertEqual(resp.status_code, 201)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_item': {'_id':3, '_auth':{'_edit':True, '_delete':True}, 'username': 'wflint', 'active': True},
+        })
+
+
+    def test_server_timing(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+        ])
+        resp = self.client.get('/api/users')
+        self.assertNotIn('Server-Timing', resp.headers)
+
+        self.app.config['TIMING'] = True
+        resp = self.client.get('/api/users?limit=1')
+        self.assertIn('count;dur=', resp.headers['Server-Timing'])
+        resp = self.client.get('/api/users')
+        self.assertEqual(resp.status_code, 200)
+        timings = dict(x.split(';dur=') for x in resp.headers['Server-Timing'].split(', '))
+        for name in ('fetch', 'add_authstates', 'serialize', 'json', 'total'):
+            self.assertIn(name, timings)
+
+
+    def test_metrics(self, ):
+        self.db.users.insert([
+            {'username': 'fflint'},    
+        ])
+        self.client.get('/api/users')
+        self.client.get('/api/users')
+        self.client.get('/api/users/1')
+        self.client.get('/api/users/5')
+        self.client.get('/api/users?q=bad')
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        lines = resp.data.splitlines()
+        self.assertIn('flipserver_requests_total{endpoint="users",route="list",method="GET",status="200"} 2', lines)
+        self.assertIn('flipserver_requests_total{endpoint="users",route="list",method="GET",status="400"} 1', lines)
+        self.assertIn('flipserver_requests_total{endpoint="users",route="item",method="GET",status="200"} 1', lines)
+        self.assertIn('flipserver_requests_total{endpoint="users",route="item",method="GET",status="404"} 1', lines)
+        self.assertIn('flipserver_request_duration_seconds_bucket{endpoint="users",route="list",method="GET",le="+Inf"} 3', lines)
+        self.assertIn('flipserver_request_duration_seconds_count{endpoint="users",route="item",method="GET"} 2', lines)
+
+
+    def test_metrics_threads(self, ):
+        import threading
+        from app.api.metrics import Metrics
+        metrics = Metrics(buckets=(0.1, 1.0))
+        def work():
+            for i in range(100):
+                metrics.observe(('users', 'list', 'GET', 200), 0.5)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        metrics.observe(('users', 'list', 'GET', 200), 0.05)
+        count, total, counts = metrics.collect()[('users', 'list', 'GET', 200)]
+        self.assertEqual((count, counts), (401, [1, 400, 0]))
+        self.assertAlmostEqual(total, 200.05)
+        self.assertEqual(len(metrics._shards), 1)       # finished threads are folded in
+
+        for i in range(50):                             # a thread per request
+            t = threading.Thread(target=metrics.add, args=('things', 1))
+            t.start()
+            t.join()
+            self.assertLessEqual(len(metrics._shards), 2)
+        self.assertEqual(metrics.counters(), {'things': 50})
+        self.assertEqual(metrics.collect()[('users', 'list', 'GET', 200)][0], 401)
+
+
+    def test_compression(self, ):
+        import zlib
+        self.db.users.insert([{'username': 'user%d' % i} for i in range(50)])
+
+        resp = self.client.get('/api/users')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        plain = json.loads(resp.data)
+
+        resp = self.client.get('/api/users', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(json.loads(zlib.decompress(resp.data, zlib.MAX_WBITS | 16)), plain)
+
+        resp = self.client.get('/api/users?stream=1', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(resp.data))['_items'], plain['_items'])
+
+        resp = self.client.get('/api/users/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        resp = self.client.get('/api/users/99', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(self.client.get('/api/users/99').data),
+                         {'_status':'ERR', 'message': 'Item not found'})
+
+        counters = self.app.metrics.counters()
+        self.assertGreater(counters['flipserver_compress_in_bytes_total'],
+                           counters['flipserver_compress_out_bytes_total'])
+        self.assertIn('flipserver_compress_seconds_total', counters)
@@ -149,12 +149,24 @@ class ErrorTests(TestCase):
         self.set_up(cfg)
         
         data = {'_id':1, 'username': 'fflint'}        
-        resp = self.client.put('/api/users',
+        resp = self.client.patch('/api/users',
                                 data=json.dumps(data),
                                 content_type = 'application/json'
                                 )
         self.assertEqual(resp.status_code, 405)        
 
+        resp = self.client.put('/api/users',
+                                data=json.dumps(data),
+                                content_type = 'application/json'
+                                )
+        self.assertEqual(resp.status_code, 400)        
+
+        resp = self.client.put('/api/users',
+                                data=json.dumps([data]),
+                                content_type = 'application/json'
+                                )
+        self.assertEqual(resp.status_code, 404)        
+
 
     def test_item_notfound(self):
         cfg = {
@@ -303,3 +315,29 @@ class ErrorTests(TestCase):
         resp = self.client.delete('/api/users/1')
         self.assertEqual(resp.status_code, 204)
         self.assertEqual(self.db.users.find().count(), 0)
+
+
+    def test_item_removed_notfound(self):
+        cfg = {
+            'users': {
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        self.db.users.insert({'username':'fflint'})
+        self.db.users.remove(1)
+        
+        resp = self.client.get('/api/users/1')
+        self.assertEqual(resp.status_code, 404)        
+
+        resp = self.client.put('/api/users/1',
+                                data=json.dumps({'username': 'brubble'}),
+                                content_type = 'application/json'
+                                )
+        self.assertEqual(resp.status_code, 404)        
+
+        resp = self.client.delete('/api/users/1')
+        self.assertEqual(resp.status_code, 404)        
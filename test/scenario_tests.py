@@ -4,6 +4,8 @@ import datetime
 
 import mongomock
 from app import create_app
+from app.api.auth_layer import ReadFilter
+from app.api.auth_layer.database import pipeline_refs
 
 import json
 from pprint import pprint as p
@@ -565,3 +567,341 @@ class ScenarioTests(TestCase):
                 }
         })
         
+
+
+    def test_delete_list_fcn_auth(self):
+        cfg = {
+            'users': {
+                'auth': {
+                    'delete': lambda x: not x.active
+                },
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble', 'active': False},    
+        ])
+
+        resp = self.client.delete('/api/users?q={"username":{"$gt":"a"}}')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {'_status': 'OK', '_count': 1})
+        self.assertEqual([x.username for x in self.db.users.find()], ['fflint'])
+
+
+    def test_delete_list_read_fcn(self):
+        cfg = {
+            'users': {
+                'auth': {
+                    'read': lambda x: x.username != 'brubble'
+                },
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+        ])
+
+        resp = self.client.delete('/api/users?q={"username":{"$gt":"a"}}')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, {'_status': 'OK', '_count': 1})
+        self.assertEqual(self.db.users.raw.find_one(1)['_active'], False)
+        self.assertEqual(self.db.users.raw.find_one(2)['_active'], True)
+
+
+    def test_user_cache(self):
+        cfg = {
+            'users': {
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        self.app.config['REQUIRE_USER'] = True
+        self.app.config['TEST_USER'] = True
+        env = {'TEST_USER': 'fflint'}
+
+        resp = self.client.get('/api/users', environ_base=env)
+        self.assertEqual(resp.status_code, 403)        
+
+        self.db.users.insert({'username': 'fflint'})
+        resp = self.client.get('/api/users', environ_base=env)
+        self.assertEqual(resp.status_code, 200)        
+        self.assertEqual(len(self.app.user_cache), 1)
+
+        # Writes that bypass the API are not seen until the entry expires
+        self.db.users.raw.remove({'username': 'fflint'})
+        resp = self.client.get('/api/users', environ_base=env)
+        self.assertEqual(resp.status_code, 200)        
+
+        self.db.users.insert({'username': 'brubble'})
+        self.assertEqual(len(self.app.user_cache), 0)
+        resp = self.client.get('/api/users', environ_base=env)
+        self.assertEqual(resp.status_code, 403)        
+
+
+    def test_read_filter_auth(self):
+        seen = []
+        def only_active(user):
+            seen.append(user)
+            return {'active': True}
+
+        cfg = {
+            'users': {
+                'auth': {
+                    'read': ReadFilter(only_active)
+                },
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble', 'active': False},    
+        ])
+
+        resp = self.client.get('/api/users')
+        self.assertEqual(resp.status_code, 200)        
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_auth': True,
+            '_status': 'OK',
+            '_items': [
+                {'_id':1, '_auth':{'_edit':True, '_delete':True}, 'username': 'fflint', 'active': True},
+            ]
+        })
+        self.assertEqual(seen, [None])
+
+        resp = self.client.get('/api/users/1')
+        self.assertEqual(resp.status_code, 200)        
+        resp = self.client.get('/api/users/2')
+        self.assertEqual(resp.status_code, 404)        
+
+
+    def test_read_filter_subdoc(self):
+        cfg = {
+            'users': {
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'roles': {'type':'list', 'schema': {'type':'dict',
+                        'auth': {
+                            'read': {'active': True},
+                        },
+                        'schema': {
+                            'name': {"type": "string", 'required': True},
+                            'active': {"type": "boolean", 'required': True, 'default': True},
+                        }
+                    }}
+                }
+            }
+        }
+        self.assertRaises(ValueError, self.set_up, cfg)
+
+
+    def test_count_auth(self):
+        cfg = {
+            'users': {
+                'auth': {
+                    'read': lambda x: x['username'] != 'brubble'
+                },
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            },
+            'groups': {
+                'auth': {
+                    'read': ReadFilter({'active': True})
+                },
+                'schema': {
+                    'name': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble'},    
+            {'username': 'wflint'},    
+        ])
+        self.db.groups.insert([
+            {'name': 'lodge'},    
+            {'name': 'quarry', 'active': False},    
+        ])
+
+        resp = self.client.get('/api/users?count=1')
+        self.assertEqual(json.loads(resp.data), {'_status': 'OK', '_count': 2})
+        resp = self.client.get('/api/groups?count=1')
+        self.assertEqual(json.loads(resp.data), {'_status': 'OK', '_count': 1})
+        resp = self.client.head('/api/users?q={"username":"wflint"}')
+        self.assertEqual(resp.headers['X-Total-Count'], '1')
+
+
+    def test_aggregate(self):
+        cfg = {
+            'orders': {
+                'auth': {
+                    'read': ReadFilter({'region': 'east'})
+                },
+                'schema': {
+                    'owner': {"type": "string"},
+                    'region': {"type": "string"},
+                    'amount': {"type": "integer"},
+                    'notes': {'type':'list', 'schema': {'type':'dict',
+                        'auth': {
+                            'read': lambda x: False,
+                        },
+                        'schema': {
+                            'text': {"type": "string"},
+                        }
+                    }}
+                }
+            },
+            'users': {
+                'auth': {
+                    'read': lambda x: True
+                },
+                'schema': {
+                    'username': {"type": "string"},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.orders.insert([
+            {'owner': 'fflint', 'region': 'east', 'amount': 5},    
+            {'owner': 'fflint', 'region': 'east', 'amount': 7},    
+            {'owner': 'brubble', 'region': 'east', 'amount': 1},    
+            {'owner': 'brubble', 'region': 'west', 'amount': 100},    
+        ])
+        self.db.orders.remove(3)
+
+        pipeline = [
+            {'$group': {'_id': '$owner', 'total': {'$sum': '$amount'}}},
+            {'$sort': {'total': -1}},
+        ]
+        resp = self.client.get('/api/orders/_aggregate', query_string={'pipeline': json.dumps(pipeline)})
+        self.assertEqual(resp.status_code, 200)        
+        data = json.loads(resp.data)
+        self.assertEqual(data, {
+            '_status': 'OK',
+            '_items': [{'_id': 'fflint', 'total': 12}],
+        })
+
+        for pipeline, status in [
+            ([{'$match': {'amount': {'$gt': 5}}}, {'$limit': 1}], 200),
+            ([{'$project': {'amount': 1}}], 400),
+            ([{'$match': {'$where': 'true'}}], 400),
+            ([{'$match': {'$jsonSchema': {'properties': {'notes': {'minItems': 1}}}}}], 400),
+            ([{'$match': {'$expr': {'$gt': [{'$size': '$notes'}, 0]}}}], 400),
+            ([{'$match': {'amount': {'$in': [1, 5]}, '$or': [{'owner': 'fflint'}, {'amount': {'$lt': 2}}]}}], 200),
+            ([{'$group': {'_id': None, 'all': {'$push': '$$ROOT'}}}], 400),
+            ([{'$limit': 0}], 400),
+            ([{'$match': {'notes.text': 'x'}}], 403),
+            ([{'$group': {'_id': '$notes'}}], 403),
+        ]:
+            resp = self.client.get('/api/orders/_aggregate', query_string={'pipeline': json.dumps(pipeline)})
+            self.assertEqual(resp.status_code, status, pipeline)
+
+        self.assertRaises(ValueError, pipeline_refs,
+                          [{'$match': {'$jsonSchema': {'properties': {'notes': {'minItems': 1}}}}}])
+        self.assertEqual(pipeline_refs([{'$group': {'_id': {'$toLower': '$owner'}, 'n': {'$sum': '$amount'}}}]),
+                         set(['owner', 'amount']))
+
+        resp = self.client.get('/api/users/_aggregate?pipeline=[]')
+        self.assertEqual(resp.status_code, 405)
+
+
+    def test_read_filter_writes(self):
+        cfg = {
+            'users': {
+                'auth': {
+                    'read': ReadFilter({'active': True})
+                },
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                    'active': {"type": "boolean", 'required': True, 'default': True},
+                }
+            }
+        }
+        self.set_up(cfg)
+        
+        self.db.users.insert([
+            {'username': 'fflint'},    
+            {'username': 'brubble', 'active': False},    
+            {'username': 'wflint'},    
+        ])
+
+        data = json.dumps({'username': 'barney'})
+        resp = self.client.put('/api/users/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, 404)        
+        resp = self.client.patch('/api/users/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, 404)        
+        resp = self.client.put('/api/users', data=json.dumps([{'_id': 2, 'username': 'barney'}]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, 404)        
+        resp = self.client.delete('/api/users/2')
+        self.assertEqual(resp.status_code, 404)        
+
+        resp = self.client.delete('/api/users?q={"username":"brubble"}')
+        self.assertEqual(json.loads(resp.data), {'_status': 'OK', '_count': 0})
+        resp = self.client.delete('/api/users?q={"_id":{"$gt":0}}')
+        self.assertEqual(json.loads(resp.data), {'_status': 'OK', '_count': 2})
+
+        data = self.db.users.raw.find_one(2)
+        self.assertEqual((data['username'], data['_active']), ('brubble', True))
+
+
+    def test_read_filter_user_delete(self):
+        cfg = {
+            'users': {
+                'schema': {
+                    'username': {"type": "string", 'required': True},
+                }
+            },
+            'notes': {
+                'auth': {
+                    'read': ReadFilter(lambda user: {'owner': user and user['username']})
+                },
+                'schema': {
+                    'owner': {"type": "string"},
+                    'text': {"type": "string"},
+                }
+            }
+        }
+        self.set_up(cfg)
+        self.app.config['REQUIRE_USER'] = True
+        self.app.config['TEST_USER'] = True
+        env = {'TEST_USER': 'fflint'}
+
+        self.db.users.insert({'username': 'fflint'})
+        self.db.notes.insert([
+            {'owner': 'fflint', 'text': 'mine'},
+            {'owner': 'brubble', 'text': 'theirs'},
+        ])
+
+        resp = self.client.delete('/api/notes/2', environ_base=env)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.delete('/api/notes/1', environ_base=env)
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.db.notes.raw.find_one(1)['_active'], False)
+        self.assertEqual(self.db.notes.raw.find_one(2)['_active'], True)